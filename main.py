@@ -26,12 +26,32 @@ from apscheduler.schedulers.background import BackgroundScheduler
 from pyrogram import Client
 
 from plugins import glovar
-from plugins.functions.timers import backup_files, clean_banned, clean_members, interval_hour_01, interval_min_10
+from plugins.functions.channel import flush_share
+from plugins.functions.etc import thread
+from plugins.functions.file import compact_journal, flush_journal, load_lazy, replay_journal, save, save_dirty
+from plugins.functions.regex import flush_count, init_rules, sort_rules
+from plugins.functions.storage import init_storage
+from plugins.functions.timers import backup_files, clean_banned, clean_members, expire_users, interval_hour_01
+from plugins.functions.timers import interval_min_10
 from plugins.functions.timers import reset_data, send_count, update_admins, update_status
 
 # Enable logging
 logger = logging.getLogger(__name__)
 
+# Load the large data in the background, messages are handled meanwhile
+for file in glovar.lazy_files:
+    thread(load_lazy, (file,))
+
+# Replay the journals of the loaded data
+for file in glovar.journal_files:
+    file not in glovar.lazy_files and replay_journal(file)
+
+# Open the database
+init_storage()
+
+# Compile regex rules
+init_rules()
+
 # Config session
 app = Client(
     session_name="bot",
@@ -46,17 +66,33 @@ update_status(app, "online")
 scheduler = BackgroundScheduler(job_defaults={"misfire_grace_time": 60})
 scheduler.add_job(interval_hour_01, "interval", [app], hours=1)
 scheduler.add_job(interval_min_10, "interval", minutes=10)
+scheduler.add_job(save_dirty, "interval", seconds=glovar.time_save)
+scheduler.add_job(flush_journal, "interval", seconds=1)
+scheduler.add_job(flush_share, "interval", [app], seconds=2)
+scheduler.add_job(compact_journal, "interval", hours=1)
+scheduler.add_job(flush_count, "interval", minutes=1)
+scheduler.add_job(sort_rules, "interval", minutes=10)
+scheduler.add_job(expire_users, "interval", [app], minutes=1)
 scheduler.add_job(update_status, "cron", [app, "awake"], minute=randint(30, 34), second=randint(0, 59))
 scheduler.add_job(clean_members, "cron", [app], hour=2)
 scheduler.add_job(clean_banned, "cron", [app], hour=3)
 scheduler.add_job(backup_files, "cron", [app], hour=20)
 scheduler.add_job(send_count, "cron", [app], hour=21)
-scheduler.add_job(reset_data, "cron", [app], day=glovar.date_reset, hour=22)
+glovar.date_reset != "off" and scheduler.add_job(reset_data, "cron", [app], day=glovar.date_reset, hour=22)
 scheduler.add_job(update_admins, "cron", [app], hour=22, minute=30)
 scheduler.start()
 
 # Hold
 app.idle()
 
+# Send the buffered exchange data before the client stops
+flush_share(app, True)
+
 # Stop
 app.stop()
+
+# Save the buffered regex count, the logged operations, the sticker queues and all changed data
+flush_count()
+flush_journal()
+save("message_ids")
+save_dirty()
@@ -18,7 +18,7 @@
 
 import logging
 from json import dumps
-from typing import List, Optional, Union
+from typing import Dict, List, Optional, Tuple, Union
 
 from pyrogram import Chat, Client, Message
 from pyrogram.errors import FloodWait
@@ -26,7 +26,7 @@ from pyrogram.errors import FloodWait
 from .. import glovar
 from .etc import code, code_block, general_link, get_forward_name, get_full_name, get_md5sum, get_text, lang
 from .etc import message_link, thread, wait_flood
-from .file import crypt_file, data_to_file, delete_file, get_new_path, save
+from .file import crypt_file, data_to_file, delete_file, get_new_path, journal
 from .image import get_file_id
 from .telegram import get_group_info, send_document, send_message
 
@@ -68,7 +68,7 @@ def declare_message(client: Client, gid: int, mid: int) -> bool:
     # Declare a message
     try:
         glovar.declared_message_ids[gid].add(mid)
-        share_data(
+        share_batch(
             client=client,
             receivers=glovar.receivers["declare"],
             action="update",
@@ -111,8 +111,28 @@ def exchange_to_hide(client: Client) -> bool:
     return False
 
 
+def flush_share(client: Client, wait: bool = False) -> bool:
+    # Share the buffered records, one envelope per action type, wait for the sending if the client is stopping
+    glovar.locks["share"].acquire()
+    try:
+        batches = glovar.share_batches
+        glovar.share_batches = {}
+    finally:
+        glovar.locks["share"].release()
+
+    try:
+        for key in batches:
+            share_records(client, key, batches[key], wait)
+
+        return True
+    except Exception as e:
+        logger.warning(f"Flush share error: {e}", exc_info=True)
+
+    return False
+
+
 def format_data(sender: str, receivers: List[str], action: str, action_type: str,
-                data: Union[bool, dict, int, str] = None) -> str:
+                data: Union[bool, dict, int, list, str] = None, batch: bool = False) -> str:
     # See https://scp-079.org/exchange/
     text = ""
     try:
@@ -123,6 +143,11 @@ def format_data(sender: str, receivers: List[str], action: str, action_type: str
             "type": action_type,
             "data": data
         }
+
+        # A batched envelope holds a list of records in data
+        if batch:
+            data["batch"] = True
+
         text = code_block(dumps(data, indent=4))
     except Exception as e:
         logger.warning(f"Format data error: {e}", exc_info=True)
@@ -307,7 +332,7 @@ def send_debug(client: Client, chat: Chat, action: str, uid: int, mid: int, em:
 def share_bad_user(client: Client, uid: int) -> bool:
     # Share a bad user with other bots
     try:
-        share_data(
+        share_batch(
             client=client,
             receivers=glovar.receivers["bad"],
             action="add",
@@ -325,13 +350,41 @@ def share_bad_user(client: Client, uid: int) -> bool:
     return False
 
 
+def share_batch(client: Client, receivers: List[str], action: str, action_type: str,
+                data: Union[dict, int, str]) -> bool:
+    # Buffer a record, records of the same action type are shared together by the next flush
+    # Only the bots listed in batch_receivers understand batched envelopes, the others get the record at once
+    if not set(receivers) & glovar.batch_receivers:
+        return share_data(client, receivers, action, action_type, data)
+
+    glovar.locks["share"].acquire()
+    try:
+        key = (tuple(receivers), action, action_type)
+        records = glovar.share_batches.setdefault(key, [])
+        records.append(data)
+
+        # A full envelope does not wait for the flush
+        if len(records) >= glovar.share_limit:
+            glovar.share_batches.pop(key)
+            share_records(client, key, records)
+
+        return True
+    except Exception as e:
+        logger.warning(f"Share batch error: {e}", exc_info=True)
+    finally:
+        glovar.locks["share"].release()
+
+    return False
+
+
 def share_data(client: Client, receivers: List[str], action: str, action_type: str,
-               data: Union[bool, dict, int, str] = None, file: str = None, encrypt: bool = True) -> bool:
+               data: Union[bool, dict, int, list, str] = None, file: str = None, encrypt: bool = True,
+               batch: bool = False) -> bool:
     # Use this function to share data in the channel
     try:
         thread(
             target=share_data_thread,
-            args=(client, receivers, action, action_type, data, file, encrypt)
+            args=(client, receivers, action, action_type, data, file, encrypt, batch)
         )
 
         return True
@@ -342,11 +395,12 @@ def share_data(client: Client, receivers: List[str], action: str, action_type: s
 
 
 def share_data_failed(client: Client, receivers: List[str], action: str, action_type: str,
-                      data: Union[bool, dict, int, str] = None, file: str = None, encrypt: bool = True) -> bool:
+                      data: Union[bool, dict, int, list, str] = None, file: str = None, encrypt: bool = True,
+                      batch: bool = False) -> bool:
     # Sharing data failed, use the exchange channel instead
     try:
         exchange_to_hide(client)
-        thread(share_data, (client, receivers, action, action_type, data, file, encrypt))
+        thread(share_data, (client, receivers, action, action_type, data, file, encrypt, batch))
 
         return True
     except Exception as e:
@@ -356,7 +410,8 @@ def share_data_failed(client: Client, receivers: List[str], action: str, action_
 
 
 def share_data_thread(client: Client, receivers: List[str], action: str, action_type: str,
-                      data: Union[bool, dict, int, str] = None, file: str = None, encrypt: bool = True) -> bool:
+                      data: Union[bool, dict, int, list, str] = None, file: str = None, encrypt: bool = True,
+                      batch: bool = False) -> bool:
     # Share data thread
     try:
         if glovar.sender in receivers:
@@ -377,11 +432,12 @@ def share_data_thread(client: Client, receivers: List[str], action: str, action_
                 receivers=receivers,
                 action=action,
                 action_type=action_type,
-                data=data
+                data=data,
+                batch=batch
             )
             result = send_message(client, channel_id, text)
             return ((result is False and not glovar.should_hide)
-                    and share_data_failed(client, receivers, action, action_type, data, file, encrypt))
+                    and share_data_failed(client, receivers, action, action_type, data, file, encrypt, batch))
 
         # Share with a file
         text = format_data(
@@ -404,7 +460,7 @@ def share_data_thread(client: Client, receivers: List[str], action: str, action_
 
         if not result:
             return ((result is False and not glovar.should_hide)
-                    and share_data_failed(client, receivers, action, action_type, data, file, encrypt))
+                    and share_data_failed(client, receivers, action, action_type, data, file, encrypt, batch))
 
         # Delete the tmp file
         for f in {file, file_path}:
@@ -417,16 +473,78 @@ def share_data_thread(client: Client, receivers: List[str], action: str, action_
     return False
 
 
-def share_regex_count(client: Client, word_type: str) -> bool:
+def share_records(client: Client, key: Tuple[Tuple[str, ...], str, str],
+                  records: List[Union[dict, int, str]], wait: bool = False) -> bool:
+    # Share buffered records, a single record or a bot without batch support gets plain envelopes
+    try:
+        receivers, action, action_type = key
+        share = (wait and share_data_thread) or share_data
+
+        if len(records) == 1:
+            return share(client, list(receivers), action, action_type, records[0])
+
+        batched = [receiver for receiver in receivers if receiver in glovar.batch_receivers]
+        plain = [receiver for receiver in receivers if receiver not in glovar.batch_receivers]
+
+        for record in records:
+            plain and share(client, list(plain), action, action_type, record)
+
+        for i in range(0, len(records), glovar.share_limit):
+            batched and share(
+                client=client,
+                receivers=list(batched),
+                action=action,
+                action_type=action_type,
+                data=records[i:i + glovar.share_limit],
+                batch=True
+            )
+
+        return True
+    except Exception as e:
+        logger.warning(f"Share records error: {e}", exc_info=True)
+
+    return False
+
+
+def share_regex_cost(client: Client, word_type: str, costs: Dict[str, Dict[str, Union[float, int]]]) -> bool:
+    # Use this function to share regex cost to REGEX
+    try:
+        if not glovar.regex.get(word_type):
+            return True
+
+        if not costs:
+            return True
+
+        file = data_to_file(costs)
+        share_data(
+            client=client,
+            receivers=["REGEX"],
+            action="regex",
+            action_type="cost",
+            data=f"{word_type}_costs",
+            file=file
+        )
+
+        return True
+    except Exception as e:
+        logger.warning(f"Share regex cost error: {e}", exc_info=True)
+
+    return False
+
+
+def share_regex_count(client: Client, word_type: str, words: Dict[str, int] = None) -> bool:
     # Use this function to share regex count to REGEX
     try:
         if not glovar.regex.get(word_type):
             return True
 
-        if not eval(f"glovar.{word_type}_words"):
+        if words is None:
+            words = eval(f"glovar.{word_type}_words")
+
+        if not words:
             return True
 
-        file = data_to_file(eval(f"glovar.{word_type}_words"))
+        file = data_to_file(words)
         share_data(
             client=client,
             receivers=["REGEX"],
@@ -446,7 +564,7 @@ def share_regex_count(client: Client, word_type: str) -> bool:
 def share_watch_user(client: Client, the_type: str, uid: int, until: str) -> bool:
     # Share a watch ban user with other bots
     try:
-        share_data(
+        share_batch(
             client=client,
             receivers=glovar.receivers["watch"],
             action="add",
@@ -470,9 +588,8 @@ def update_score(client: Client, uid: int) -> bool:
     try:
         count = len(glovar.user_ids[uid]["detected"])
         score = count * 0.6
-        glovar.user_ids[uid]["score"][glovar.sender.lower()] = score
-        save("user_ids")
-        share_data(
+        journal("user_ids", "set", (uid, "score", glovar.sender.lower()), score)
+        share_batch(
             client=client,
             receivers=glovar.receivers["score"],
             action="update",
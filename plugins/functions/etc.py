@@ -31,7 +31,7 @@ from typing import Any, Callable, Dict, List, Optional, Union
 from unicodedata import normalize
 
 from cryptography.fernet import Fernet
-from opencc import convert
+from opencc import OpenCC
 from pyrogram import Contact, InlineKeyboardMarkup, Message, MessageEntity, User
 from pyrogram.errors import FloodWait
 
@@ -222,10 +222,52 @@ def get_entity_text(message: Message, entity: MessageEntity) -> str:
     return result
 
 
+def get_emoji_dict(text: str) -> Dict[str, int]:
+    # Get the emoji in the text and their counts, an emoji inside a longer one is not counted
+    result = {}
+
+    try:
+        if not text:
+            return {}
+
+        emoji_set = set()
+
+        # Find all emoji that start at each position
+        for i in range(len(text)):
+            node = glovar.emoji_trie.get(text[i])
+            j = i + 1
+
+            while node:
+                if "" in node:
+                    emoji_set.add(node[""])
+
+                if j >= len(text):
+                    break
+
+                node = node.get(text[j])
+                j += 1
+
+        for emoji in emoji_set:
+            if any(emoji in emoji_other and emoji != emoji_other for emoji_other in emoji_set):
+                continue
+
+            result[emoji] = text.count(emoji)
+    except Exception as e:
+        logger.warning(f"Get emoji dict error: {e}", exc_info=True)
+
+    return result
+
+
 def get_filename(message: Message, normal: bool = False, printable: bool = False) -> str:
     # Get file's filename
     text = ""
     try:
+        views = get_views(message)
+        view = ("filename", normal, printable)
+
+        if view in views:
+            return views[view]
+
         if message.document:
             if message.document.file_name:
                 text += message.document.file_name
@@ -235,6 +277,8 @@ def get_filename(message: Message, normal: bool = False, printable: bool = False
 
         if text:
             text = t2t(text, normal, printable)
+
+        views[view] = text
     except Exception as e:
         logger.warning(f"Get filename error: {e}", exc_info=True)
 
@@ -245,6 +289,12 @@ def get_forward_name(message: Message, normal: bool = False, printable: bool = F
     # Get forwarded message's origin sender's name
     text = ""
     try:
+        views = get_views(message)
+        view = ("forward", normal, printable)
+
+        if view in views:
+            return views[view]
+
         if message.forward_from:
             user = message.forward_from
             text = get_full_name(user, normal, printable)
@@ -256,6 +306,8 @@ def get_forward_name(message: Message, normal: bool = False, printable: bool = F
 
         if text:
             text = t2t(text, normal, printable)
+
+        views[view] = text
     except Exception as e:
         logger.warning(f"Get forward name error: {e}", exc_info=True)
 
@@ -492,6 +544,18 @@ def get_text(message: Message, normal: bool = False, printable: bool = False) ->
         if not message:
             return ""
 
+        views = get_views(message)
+        view = ("text", normal, printable)
+
+        if view in views:
+            return views[view]
+
+        # Convert the raw text, which is also a view
+        if normal or printable:
+            text = t2t(get_text(message), normal, printable)
+            views[view] = text
+            return text
+
         the_text = message.text or message.caption
 
         if the_text:
@@ -521,14 +585,42 @@ def get_text(message: Message, normal: bool = False, printable: bool = False) ->
                     if button.url:
                         text += f"\n{button.url}"
 
-        if text:
-            text = t2t(text, normal, printable)
+        views[view] = text
     except Exception as e:
         logger.warning(f"Get text error: {e}", exc_info=True)
 
     return text
 
 
+def get_views(message: Message) -> Dict[tuple, str]:
+    # Get the cached text views of the message, the whole check of a message runs in the same thread
+    result = {}
+    try:
+        if not message or not message.message_id:
+            return {}
+
+        key = (message.chat and message.chat.id, message.message_id, message.date, message.edit_date)
+        views = getattr(glovar.message_views, "views", None)
+
+        if views is None:
+            glovar.message_views.views = views = {}
+
+        result = views.get(key)
+
+        if result is not None:
+            return result
+
+        # Keep the views of the recent messages only, such as the message and its pinned message
+        if len(views) >= 4:
+            views.clear()
+
+        result = views[key] = {}
+    except Exception as e:
+        logger.warning(f"Get views error: {e}", exc_info=True)
+
+    return result
+
+
 def lang(text: str) -> str:
     # Get the text
     result = ""
@@ -574,6 +666,38 @@ def random_str(i: int) -> str:
     return text
 
 
+def t2s(text: str) -> str:
+    # Convert traditional Chinese to simplified Chinese, short texts such as names are cached
+    result = text
+    glovar.locks["t2s"].acquire()
+    try:
+        short = len(text) <= glovar.t2s_cache_length
+
+        if short and text in glovar.t2s_cache:
+            glovar.t2s_cache.move_to_end(text)
+            return glovar.t2s_cache[text]
+
+        # Reuse the converter, the config is only loaded once
+        if glovar.t2s_converter is None:
+            glovar.t2s_converter = OpenCC("t2s.json")
+
+        result = glovar.t2s_converter.convert(text)
+
+        if not short:
+            return result
+
+        glovar.t2s_cache[text] = result
+
+        if len(glovar.t2s_cache) > glovar.t2s_cache_limit:
+            glovar.t2s_cache.popitem(last=False)
+    except Exception as e:
+        logger.warning(f"T2S error: {e}", exc_info=True)
+    finally:
+        glovar.locks["t2s"].release()
+
+    return result
+
+
 def t2t(text: str, normal: bool, printable: bool, pure: bool = False) -> str:
     # Convert the string, text to text
     try:
@@ -581,16 +705,14 @@ def t2t(text: str, normal: bool, printable: bool, pure: bool = False) -> str:
             return ""
 
         if normal:
-            for special in ["spc", "spe"]:
-                text = "".join(eval(f"glovar.{special}_dict").get(t, t) for t in text)
-
+            text = text.translate(glovar.special_table)
             text = normalize("NFKC", text)
 
         if printable:
             text = "".join(t for t in text if t.isprintable() or t in {"\n", "\r", "\t"})
 
         if normal and glovar.zh_cn:
-            text = convert(text, config="t2s.json")
+            text = t2s(text)
 
         if pure:
             text = sub(r"""[^\da-zA-Z一-龥.,:'"?!~;()。，？！～@“”]""", "", text)
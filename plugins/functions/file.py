@@ -17,23 +17,42 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-from os import remove
-from os.path import exists
-from pickle import dump
-from shutil import copyfile
-from typing import Any
+from hashlib import sha256
+from io import BytesIO
+from json import dumps as json_dumps
+from os import O_RDONLY, close, fsync, getpid, kill, open as open_fd, remove, replace
+from os.path import exists, getsize
+from pickle import dump, dumps, load
+from signal import SIGTERM
+from tarfile import TarInfo, open as open_tar
+from typing import Any, Callable, Dict, Tuple
 
 from pyAesCrypt import decryptFile, encryptFile
 from pyrogram import Client
 
 from .. import glovar
-from .etc import random_str, thread
+from .etc import random_str
+from .storage import save_storage, trim_storage, update_storage
 from .telegram import download_media
 
 # Enable logging
 logger = logging.getLogger(__name__)
 
 
+def compact_journal() -> bool:
+    # Mark the journaled global variables that have logged operations, they will be saved as new snapshots
+    try:
+        for file in glovar.journal_files:
+            if exists(f"data/{file}.journal") and getsize(f"data/{file}.journal"):
+                save(file)
+
+        return True
+    except Exception as e:
+        logger.warning(f"Compact journal error: {e}", exc_info=True)
+
+    return False
+
+
 def crypt_file(operation: str, file_in: str, file_out: str) -> bool:
     # Encrypt or decrypt a file
     try:
@@ -54,6 +73,26 @@ def crypt_file(operation: str, file_in: str, file_out: str) -> bool:
     return False
 
 
+def data_to_archive(contents: Dict[str, bytes], manifest: dict) -> str:
+    # Save pickled data and a manifest to a compressed archive in tmp directory
+    try:
+        file_path = get_new_path(".tar.xz")
+        members = dict(contents)
+        members["manifest.json"] = json_dumps(manifest).encode("utf-8")
+
+        with open_tar(file_path, "w:xz") as tar:
+            for name in members:
+                info = TarInfo(name)
+                info.size = len(members[name])
+                tar.addfile(info, BytesIO(members[name]))
+
+        return file_path
+    except Exception as e:
+        logger.warning(f"Data to archive error: {e}", exc_info=True)
+
+    return ""
+
+
 def data_to_file(data: Any) -> str:
     # Save data to a file in tmp directory
     try:
@@ -82,6 +121,37 @@ def delete_file(path: str) -> bool:
     return False
 
 
+def flush_journal() -> bool:
+    # Append the logged operations to the journal files, sync each file once per batch
+    glovar.locks["save"].acquire()
+    try:
+        batches = {}
+
+        while glovar.journal_ops:
+            file, operation = glovar.journal_ops.popleft()
+            batches.setdefault(file, []).append(operation)
+
+        for file in batches:
+            if glovar.storage_backend == "sqlite" and file in glovar.storage_files:
+                update_storage(file, batches[file])
+                continue
+
+            with open(f"data/{file}.journal", "ab") as f:
+                f.write(b"".join(dumps(operation) for operation in batches[file]))
+                f.flush()
+                fsync(f.fileno())
+
+        glovar.storage_backend == "sqlite" and trim_storage()
+
+        return True
+    except Exception as e:
+        logger.error(f"Flush journal error: {e}", exc_info=True)
+    finally:
+        glovar.locks["save"].release()
+
+    return False
+
+
 def get_downloaded_path(client: Client, file_id: str, file_ref: str) -> str:
     # Download file, get it's path on local machine
     final_path = ""
@@ -113,10 +183,129 @@ def get_new_path(extension: str = "", prefix: str = "") -> str:
     return result
 
 
+def is_ready(file: str) -> bool:
+    # Check if a global variable has been loaded
+    try:
+        return file not in glovar.lazy_ready or glovar.lazy_ready[file].is_set()
+    except Exception as e:
+        logger.warning(f"Is ready error: {e}", exc_info=True)
+
+    return False
+
+
+def journal(file: str, operation: str, path: Tuple, value: Any = None, check: Callable[[], bool] = None) -> bool:
+    # Change a journaled global variable, log the operation for the next flush
+    glovar.locks["journal"].acquire()
+    try:
+        # The check runs under the lock, so no other change can come between the check and the operation
+        if check and not check():
+            return False
+
+        # The handlers never wait for a loading file, the operation is applied again to the loaded data
+        if not is_ready(file):
+            journal_apply(file, (operation, path, value))
+            glovar.lazy_pending[file].append((operation, path, value))
+            return True
+
+        if not journal_apply(file, (operation, path, value)):
+            return False
+
+        glovar.journal_ops.append((file, (operation, path, value)))
+
+        return True
+    except Exception as e:
+        logger.warning(f"Journal error: {e}", exc_info=True)
+    finally:
+        glovar.locks["journal"].release()
+
+    return False
+
+
+def journal_apply(file: str, operation: Tuple) -> bool:
+    # Apply a logged operation to a global variable
+    try:
+        operation, path, value = operation
+        data = eval(f"glovar.{file}")
+
+        for key in path[:-1]:
+            data = data[key]
+
+        if operation == "init":
+            data.setdefault(path[-1], value)
+        elif operation == "pop":
+            data.pop(path[-1], None)
+        elif operation == "set":
+            data[path[-1]] = value
+        else:
+            return False
+
+        return True
+    except Exception as e:
+        logger.warning(f"Journal apply error: {e}", exc_info=True)
+
+    return False
+
+
+def load_lazy(file: str) -> bool:
+    # Load a large global variable in the background, then open its readiness gate
+    try:
+        if not glovar.load_data(file) or not replay_journal(file):
+            raise SystemExit("[DATA CORRUPTION]")
+
+        # Apply the operations logged during the load, then open the gate
+        with glovar.locks["journal"]:
+            for operation in glovar.lazy_pending[file]:
+                journal_apply(file, operation)
+                glovar.journal_ops.append((file, operation))
+
+            glovar.lazy_pending[file] = []
+            glovar.lazy_ready[file].set()
+
+        return True
+    except (Exception, SystemExit) as e:
+        logger.critical(f"Load lazy {file} error: {e}", exc_info=True)
+        kill(getpid(), SIGTERM)
+
+    return False
+
+
+def replay_journal(file: str) -> bool:
+    # Replay a journal file on top of the loaded snapshot, then compact it
+    try:
+        if file not in glovar.journal_files:
+            return True
+
+        if not exists(f"data/{file}.journal") or not getsize(f"data/{file}.journal"):
+            return True
+
+        count = 0
+
+        with open(f"data/{file}.journal", "rb") as f:
+            while True:
+                try:
+                    operation = load(f)
+                except EOFError:
+                    break
+                except Exception as e:
+                    logger.warning(f"Journal {file} is truncated after {count} operations: {e}")
+                    break
+
+                journal_apply(file, operation)
+                count += 1
+
+        # Write a new snapshot, so a torn tail never stays in front of the next appended operations
+        glovar.storage_backend == "pickle" and save_thread(file)
+
+        return True
+    except Exception as e:
+        logger.critical(f"Replay journal error: {e}", exc_info=True)
+        raise SystemExit("[DATA CORRUPTION]")
+
+
 def save(file: str) -> bool:
-    # Save a global variable to a file
+    # Mark a global variable to be saved, the changes are written together later
     try:
-        thread(save_thread, (file,))
+        glovar.save_dirty.add(file)
 
         return True
     except Exception as e:
@@ -125,16 +314,62 @@ def save(file: str) -> bool:
     return False
 
 
+def save_dirty() -> bool:
+    # Save all marked global variables, only one dump runs at a time
+    glovar.locks["save"].acquire()
+    try:
+        for file in list(glovar.save_dirty):
+            # A variable that is still loading must not overwrite its snapshot
+            if not is_ready(file):
+                continue
+
+            glovar.save_dirty.discard(file)
+
+            # A failed dump, such as one of a variable changed during it, is tried again next time
+            if not save_thread(file):
+                glovar.save_dirty.add(file)
+
+        return True
+    except Exception as e:
+        logger.warning(f"Save dirty error: {e}", exc_info=True)
+    finally:
+        glovar.locks["save"].release()
+
+    return False
+
+
 def save_thread(file: str) -> bool:
     # Save thread
     try:
         if not glovar:
             return True
 
-        with open(f"data/.{file}", "wb") as f:
-            dump(eval(f"glovar.{file}"), f)
+        if glovar.storage_backend == "sqlite" and file in glovar.storage_files:
+            return save_storage(file)
+
+        # Write the new generation once, then rename it over the current one, which becomes the previous one
+        content = dumps(eval(f"glovar.{file}"))
+        generation = glovar.save_generations.get(file, 0) + 1
+
+        with open(f"data/{file}.tmp", "wb") as f:
+            f.write(glovar.save_magic + generation.to_bytes(8, "big") + sha256(content).digest())
+            f.write(content)
+            f.flush()
+            fsync(f.fileno())
+
+        exists(f"data/{file}") and replace(f"data/{file}", f"data/.{file}")
+        replace(f"data/{file}.tmp", f"data/{file}")
+
+        # Make the renames durable
+        fd = open_fd("data", O_RDONLY)
+        fsync(fd)
+        close(fd)
+
+        glovar.save_generations[file] = generation
 
-        copyfile(f"data/.{file}", f"data/{file}")
+        # The snapshot already contains every logged operation, operations applied after the dump are still buffered
+        if file in glovar.journal_files:
+            open(f"data/{file}.journal", "wb").close()
 
         return True
     except Exception as e:
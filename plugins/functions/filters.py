@@ -18,20 +18,19 @@
 
 import logging
 import re
-from copy import deepcopy
-from string import ascii_lowercase
-from typing import Match, Optional, Union
+from typing import Dict, List, Match, Optional, Union
 
 from pyrogram import CallbackQuery, Client, Filters, Message, User
 
 from .. import glovar
 from .channel import get_content
-from .etc import get_channel_link, get_command_type, get_entity_text, get_now, get_links, get_md5sum
+from .etc import get_channel_link, get_command_type, get_emoji_dict, get_entity_text, get_now, get_links, get_md5sum
 from .etc import get_stripped_link, get_text, thread
-from .file import delete_file, get_downloaded_path, save
+from .file import delete_file, get_downloaded_path
 from .group import get_description, get_group_sticker, get_member, get_pinned
 from .ids import init_group_id
 from .image import get_file_id, get_qrcode
+from .regex import match_group, match_text
 from .telegram import resolve_username
 
 # Enable logging
@@ -296,19 +295,36 @@ test_group = Filters.create(
 )
 
 
-def is_ad_text(text: str, ocr: bool, matched: str = "") -> str:
-    # Check if the text is ad text
+def count_ad_text(hits: Dict[str, str], categories: List[str]) -> bool:
+    # Count the hits of the ad categories that a verdict is based on
+    try:
+        for c in categories:
+            glovar.regex_hits.append((f"ad{c}", hits[c]))
+
+        return True
+    except Exception as e:
+        logger.warning(f"Count ad text error: {e}", exc_info=True)
+
+    return False
+
+
+def is_ad_text(text: str, ocr: bool) -> Dict[str, str]:
+    # Check if the text is ad text, return the matched rule of each ad category it hits, the callers count the hits
+    result = {}
+
     try:
         if not text:
-            return ""
+            return {}
 
-        for c in ascii_lowercase:
-            if c != matched and is_regex_text(f"ad{c}", text, ocr):
-                return c
+        hits = match_group("ad", text, ocr)
+
+        for word_type in hits:
+            rule, _ = hits[word_type]
+            result[word_type[2:]] = rule["word"]
     except Exception as e:
         logger.warning(f"Is ad text error: {e}", exc_info=True)
 
-    return ""
+    return result
 
 
 def is_ban_text(text: str, ocr: bool, message: Message = None) -> bool:
@@ -334,16 +350,18 @@ def is_ban_text(text: str, ocr: bool, message: Message = None) -> bool:
         ad = is_ad_text(text, ocr)
 
         if ad and con:
+            count_ad_text(ad, list(ad)[:1])
             return True
 
         # ad_ + emoji
         if ad and emoji:
+            count_ad_text(ad, list(ad)[:1])
             return True
 
         # ad_ + ad_
-        if ad:
-            ad = is_ad_text(text, ocr, ad)
-            return bool(ad)
+        if len(ad) > 1:
+            count_ad_text(ad, list(ad)[:2])
+            return True
     except Exception as e:
         logger.warning(f"Is ban text error: {e}", exc_info=True)
 
@@ -483,7 +501,7 @@ def is_detected_user_id(gid: int, uid: int, now: int) -> bool:
         if not user_status:
             return False
 
-        status = user_status["detected"].get(gid, 0)
+        status = user_status.get("detected", {}).get(gid, 0)
 
         if now - status < glovar.time_punish:
             return True
@@ -499,16 +517,7 @@ def is_emoji(the_type: str, text: str, message: Message = None) -> bool:
         if message:
             text = get_text(message, False, False)
 
-        emoji_dict = {}
-        emoji_set = {emoji for emoji in glovar.emoji_set if emoji in text and emoji not in glovar.emoji_protect}
-        emoji_old_set = deepcopy(emoji_set)
-
-        for emoji in emoji_old_set:
-            if any(emoji in emoji_old and emoji != emoji_old for emoji_old in emoji_old_set):
-                emoji_set.discard(emoji)
-
-        for emoji in emoji_set:
-            emoji_dict[emoji] = text.count(emoji)
+        emoji_dict = get_emoji_dict(text)
 
         # Check ad
         if the_type == "ad":
@@ -955,9 +964,9 @@ def is_not_allowed(client: Client, message: Message, text: str = None, image_pat
                         and message.document.mime_type
                         and "gif" in message.document.mime_type)
                     or message.dice):
+                # The queue is saved with the hourly expiry
                 mid = message.message_id
-                glovar.message_ids[gid]["stickers"][mid] = now
-                save("message_ids")
+                glovar.message_ids[gid]["stickers"].append((mid, now))
                 return ""
 
         # Preview message
@@ -1012,39 +1021,18 @@ def is_not_allowed(client: Client, message: Message, text: str = None, image_pat
     return ""
 
 
-def is_regex_text(word_type: str, text: str, ocr: bool = False, again: bool = False) -> Optional[Match]:
+def is_regex_text(word_type: str, text: str, ocr: bool = False) -> Optional[Match]:
     # Check if the text hit the regex rules
     result = None
     try:
-        if text:
-            if not again:
-                text = re.sub(r"\s{2,}", " ", text)
-            elif " " in text:
-                text = re.sub(r"\s", "", text)
-            else:
-                return None
-        else:
+        if not text:
             return None
 
-        with glovar.locks["regex"]:
-            words = list(eval(f"glovar.{word_type}_words"))
-
-        for word in words:
-            if ocr and "(?# nocr)" in word:
-                continue
+        rule, result = match_text(word_type, text, ocr)
 
-            result = re.search(word, text, re.I | re.S | re.M)
-
-            # Count and return
-            if result:
-                count = eval(f"glovar.{word_type}_words").get(word, 0)
-                count += 1
-                eval(f"glovar.{word_type}_words")[word] = count
-                save(f"{word_type}_words")
-                return result
-
-        # Try again
-        return is_regex_text(word_type, text, ocr, True)
+        # Count, the hits are flushed to the word lists later
+        if result:
+            glovar.regex_hits.append((word_type, rule["word"]))
     except Exception as e:
         logger.warning(f"Is regex text error: {e}", exc_info=True)
 
@@ -1175,9 +1163,12 @@ def is_wb_text(text: str, ocr: bool) -> bool:
                 or is_regex_text("spc", text, ocr)):
             return True
 
-        for c in ascii_lowercase:
-            if c not in {"i"} and is_regex_text(f"ad{c}", text, ocr):
-                return True
+        ad = is_ad_text(text, ocr)
+        categories = [c for c in ad if c not in {"i"}]
+
+        if categories:
+            count_ad_text(ad, categories[:1])
+            return True
     except Exception as e:
         logger.warning(f"Is wb text error: {e}", exc_info=True)
 
@@ -18,14 +18,61 @@
 
 import logging
 from copy import deepcopy
+from heapq import heapify, heappop, heappush
+from typing import List, Tuple
 
 from .. import glovar
-from .file import save
+from .file import journal, save
+from .storage import get_expired
 
 # Enable logging
 logger = logging.getLogger(__name__)
 
 
+def get_expired_times(key: str, until: int, limit: int = 10000) -> List[Tuple[int, int, int]]:
+    # Get the join or detected times that are older than until, the oldest first
+    result = []
+
+    try:
+        if glovar.storage_backend == "sqlite":
+            return get_expired(key, until, limit)
+
+        with glovar.locks["expire"]:
+            heap = glovar.expire_heaps[key]
+
+            while heap and heap[0][0] < until and len(result) < limit:
+                result.append(heappop(heap))
+    except Exception as e:
+        logger.warning(f"Get expired times error: {e}", exc_info=True)
+
+    return result
+
+
+def init_expire_heaps() -> bool:
+    # Index all loaded join and detected times
+    try:
+        if glovar.expire_built or glovar.storage_backend != "pickle":
+            return True
+
+        for key in glovar.expire_heaps:
+            heap = [(time, uid, gid)
+                    for uid, status in list(glovar.user_ids.items())
+                    for gid, time in list((status.get(key) or {}).items())]
+
+            with glovar.locks["expire"]:
+                heap += glovar.expire_heaps[key]
+                heapify(heap)
+                glovar.expire_heaps[key] = heap
+
+        glovar.expire_built = True
+
+        return True
+    except Exception as e:
+        logger.warning(f"Init expire heaps error: {e}", exc_info=True)
+
+    return False
+
+
 def init_group_id(gid: int) -> bool:
     # Init group data
     try:
@@ -74,11 +121,95 @@ def init_user_id(uid: int) -> bool:
     # Init user data
     try:
         if glovar.user_ids.get(uid) is None:
-            glovar.user_ids[uid] = deepcopy(glovar.default_user_status)
-            save("user_ids")
+            journal("user_ids", "init", (uid,), glovar.UserStatus())
 
         return True
     except Exception as e:
         logger.warning(f"Init user id {uid} error: {e}", exc_info=True)
 
     return False
+
+
+def is_status_empty(uid: int) -> bool:
+    # Check if a user has no join time, detected time or score left
+    try:
+        status = glovar.user_ids.get(uid)
+
+        if not status:
+            return False
+
+        return not (status.get("join") or status.get("detected") or any(status["score"].values()))
+    except Exception as e:
+        logger.warning(f"Is status empty error: {e}", exc_info=True)
+
+    return False
+
+
+def is_time_indexed(uid: int, key: str, gid: int, time: int) -> bool:
+    # Check if a user's join or detected time in a group is still the indexed one
+    try:
+        status = glovar.user_ids.get(uid)
+
+        return bool(status) and status.get(key, {}).get(gid) == time
+    except Exception as e:
+        logger.warning(f"Is time indexed error: {e}", exc_info=True)
+
+    return False
+
+
+def reindex_user_time(uid: int, key: str, gid: int) -> bool:
+    # Index a user's join or detected time again, after an older time of the group was popped from the index
+    try:
+        if glovar.storage_backend != "pickle":
+            return True
+
+        status = glovar.user_ids.get(uid)
+        time = status and status.get(key, {}).get(gid)
+
+        if not time:
+            return True
+
+        with glovar.locks["expire"]:
+            heappush(glovar.expire_heaps[key], (time, uid, gid))
+
+        return True
+    except Exception as e:
+        logger.warning(f"Reindex user time error: {e}", exc_info=True)
+
+    return False
+
+
+def reset_expire_heaps() -> bool:
+    # Drop the index after user_ids was replaced, the expiry builds it again from the new data
+    try:
+        with glovar.locks["expire"]:
+            glovar.expire_heaps = {key: [] for key in glovar.expire_heaps}
+            glovar.expire_built = False
+
+        return True
+    except Exception as e:
+        logger.warning(f"Reset expire heaps error: {e}", exc_info=True)
+
+    return False
+
+
+def set_user_time(uid: int, key: str, gid: int, now: int) -> bool:
+    # Set a user's join or detected time in a group, index it for the expiry
+    try:
+        # A time that is already indexed is indexed again with its newest value when the old entry is popped
+        status = glovar.user_ids.get(uid)
+        indexed = bool(status) and gid in status.get(key, {})
+
+        if not journal("user_ids", "set", (uid, key, gid), now):
+            return False
+
+        # The SQLite backend uses the time index of its tables
+        if glovar.storage_backend == "pickle" and not indexed:
+            with glovar.locks["expire"]:
+                heappush(glovar.expire_heaps[key], (now, uid, gid))
+
+        return True
+    except Exception as e:
+        logger.warning(f"Set user time error: {e}", exc_info=True)
+
+    return False
@@ -18,9 +18,10 @@
 
 import logging
 import pickle
-from copy import deepcopy
+from hashlib import sha256
 from json import loads
-from typing import Any
+from tarfile import open as open_tar
+from typing import Any, Dict
 
 from pyrogram import Client, InlineKeyboardButton, InlineKeyboardMarkup, Message
 
@@ -28,11 +29,14 @@ from .. import glovar
 from .channel import get_content, get_debug_text, share_data
 from .etc import code, crypt_str, general_link, get_int, get_now, get_report_record, get_stripped_link, get_text, lang
 from .etc import mention_id, thread
-from .file import crypt_file, data_to_file, delete_file, get_new_path, get_downloaded_path, save
+from .file import crypt_file, data_to_file, delete_file, get_new_path, get_downloaded_path, journal
+from .file import save
 from .filters import is_class_e, is_declared_message_id, is_detected_user_id, is_not_allowed
 from .group import get_config_text, leave_group
-from .ids import init_group_id, init_user_id
+from .ids import init_group_id, init_user_id, reset_expire_heaps
 from .image import get_image_hash
+from .regex import compile_rules, get_slow
+from .storage import clear_joins
 from .telegram import get_messages, send_message, send_report_message
 from .timers import update_admins
 from .user import terminate_user
@@ -120,6 +124,44 @@ def receive_add_except(client: Client, data: dict) -> bool:
     return False
 
 
+def receive_archive_data(client: Client, message: Message) -> Dict[str, Any]:
+    # Receive an archive's data from exchange channel, check each file against the manifest
+    result = {}
+    try:
+        if not message.document:
+            return {}
+
+        file_id = message.document.file_id
+        file_ref = message.document.file_ref
+        path = get_downloaded_path(client, file_id, file_ref)
+
+        if not path:
+            return {}
+
+        # Decrypt the file, save to the tmp directory
+        path_decrypted = get_new_path()
+        crypt_file("decrypt", path, path_decrypted)
+
+        with open_tar(path_decrypted, "r:*") as tar:
+            manifest = loads(tar.extractfile("manifest.json").read().decode("utf-8"))
+
+            for file in manifest["hashes"]:
+                content = tar.extractfile(file).read()
+
+                if sha256(content).hexdigest() != manifest["hashes"][file]:
+                    logger.warning(f"Receive archive data {file} checksum mismatch")
+                    continue
+
+                result[file] = pickle.loads(content)
+
+        for f in {path, path_decrypted}:
+            thread(delete_file, (f,))
+    except Exception as e:
+        logger.warning(f"Receive archive data error: {e}", exc_info=True)
+
+    return result
+
+
 def receive_captcha_flood(data: dict) -> bool:
     # Receive captcha flood status
     result = False
@@ -163,8 +205,7 @@ def receive_captcha_kicked_user(data: dict) -> bool:
         if not glovar.user_ids.get(uid, {}):
             return True
 
-        glovar.user_ids[uid]["join"].pop(gid, 0)
-        save("user_ids")
+        journal("user_ids", "pop", (uid, "join", gid))
 
         result = True
     except Exception as e:
@@ -194,9 +235,7 @@ def receive_captcha_kicked_users(client: Client, message: Message, data: int) ->
 
         # Remove group status
         for uid in uids:
-            glovar.user_ids.get(uid, {}) and glovar.user_ids[uid]["join"].pop(gid, 0)
-
-        save("user_ids")
+            glovar.user_ids.get(uid, {}) and journal("user_ids", "pop", (uid, "join", gid))
 
         result = True
     except Exception as e:
@@ -239,11 +278,15 @@ def receive_clear_data(client: Client, data_type: str, data: dict) -> bool:
         if data_type == "user":
             if the_type == "all":
                 glovar.user_ids = {}
+                reset_expire_heaps()
+                save("user_ids")
+            elif the_type == "new" and glovar.storage_backend == "sqlite":
+                clear_joins()
             elif the_type == "new":
                 for uid in list(glovar.user_ids):
                     glovar.user_ids[uid]["join"] = {}
 
-            save("user_ids")
+                save("user_ids")
 
         # Clear watch data
         if data_type == "watch":
@@ -431,9 +474,7 @@ def receive_flood_score(client: Client, message: Message) -> bool:
         user_list = [uid for uid in list(users) if init_user_id(uid)]
 
         for uid in user_list:
-            glovar.user_ids[uid]["score"]["captcha"] = users[uid]
-
-        save("user_ids")
+            journal("user_ids", "set", (uid, "score", "captcha"), users[uid])
     except Exception as e:
         logger.warning(f"Receive flood score error: {e}", exc_info=True)
     finally:
@@ -574,23 +615,32 @@ def receive_regex(client: Client, message: Message, data: str) -> bool:
         if words_data is None:
             return True
 
-        pop_set = set(eval(f"glovar.{file_name}")) - set(words_data)
-        new_set = set(words_data) - set(eval(f"glovar.{file_name}"))
+        # Replace the word list with a new one, keep the counts of the remaining words
+        with glovar.locks["count"]:
+            words = eval(f"glovar.{file_name}")
+            new_words = {word: words.get(word, 0) for word in words_data}
+            exec(f"glovar.{file_name} = new_words")
 
-        for word in pop_set:
-            eval(f"glovar.{file_name}").pop(word, 0)
+        save(file_name)
 
-        for word in new_set:
-            eval(f"glovar.{file_name}")[word] = 0
+        # Quarantine the new rules that are too slow
+        slow = glovar.slow_rules.get(word_type, set()) & set(new_words)
+        slow |= get_slow([word for word in new_words if word not in words])
+        glovar.slow_rules[word_type] = slow
+        save("slow_rules")
 
-        save(file_name)
+        for word in slow:
+            logger.warning(f"Quarantine {word_type} rule: {word}")
+
+        # Recompile the rules
+        compile_rules([word_type])
 
         # Regenerate special characters dictionary if possible
         if file_name not in {"spc_words", "spe_words"}:
             return True
 
         special = file_name.split("_")[0]
-        exec(f"glovar.{special}_dict = {{}}")
+        special_dict = {}
 
         for rule in words_data:
             # Check keys
@@ -605,7 +655,15 @@ def receive_regex(client: Client, message: Message, data: str) -> bool:
             value = rule.split("?#")[1][1]
 
             for k in keys:
-                eval(f"glovar.{special}_dict")[k] = value
+                special_dict[k] = value
+
+        exec(f"glovar.{special}_dict = special_dict")
+
+        # Regenerate the translation table, then replace the old one
+        glovar.special_table = {
+            ord(k): glovar.spe_dict.get(glovar.spc_dict.get(k, k), glovar.spc_dict.get(k, k))
+            for k in set(glovar.spc_dict) | set(glovar.spe_dict)
+        }
 
         return True
     except Exception as e:
@@ -630,11 +688,9 @@ def receive_remove_bad(data: dict) -> bool:
         # Remove bad user
         if the_type == "user":
             glovar.bad_ids["users"].discard(the_id)
-            glovar.watch_ids["ban"].pop(the_id, {})
-            glovar.watch_ids["delete"].pop(the_id, {})
-            save("watch_ids")
-            glovar.user_ids[the_id] = deepcopy(glovar.default_user_status)
-            save("user_ids")
+            journal("watch_ids", "pop", ("ban", the_id))
+            journal("watch_ids", "pop", ("delete", the_id))
+            journal("user_ids", "set", (the_id,), glovar.UserStatus())
 
         save("bad_ids")
 
@@ -712,8 +768,7 @@ def receive_remove_score(data: int) -> bool:
         if not glovar.user_ids.get(uid):
             return True
 
-        glovar.user_ids[uid] = deepcopy(glovar.default_user_status)
-        save("user_ids")
+        journal("user_ids", "set", (uid,), glovar.UserStatus())
 
         return True
     except Exception as e:
@@ -731,9 +786,8 @@ def receive_remove_watch(data: int) -> bool:
         uid = data
 
         # Reset watch status
-        glovar.watch_ids["ban"].pop(uid, 0)
-        glovar.watch_ids["delete"].pop(uid, 0)
-        save("watch_ids")
+        journal("watch_ids", "pop", ("ban", uid))
+        journal("watch_ids", "pop", ("delete", uid))
 
         return True
     except Exception as e:
@@ -768,13 +822,31 @@ def receive_rollback(client: Client, message: Message, data: dict) -> bool:
         # Basic data
         aid = data["admin_id"]
         the_type = data["type"]
-        the_data = receive_file_data(client, message)
 
-        if not the_data:
+        # An archive holds several files
+        if the_type in {"archive", "archive_full"}:
+            files = receive_archive_data(client, message)
+        else:
+            files = {the_type: receive_file_data(client, message)}
+
+        files = {file: files[file] for file in files if file in glovar.file_list and files[file]}
+
+        if not files:
             return True
 
-        exec(f"glovar.{the_type} = the_data")
-        save(the_type)
+        for file in files:
+            exec(f"glovar.{file} = glovar.convert_data(file, files[file])")
+            save(file)
+
+        # The restored join and detected times are indexed again
+        "user_ids" in files and reset_expire_heaps()
+
+        # The restored rules take effect at once
+        word_types = [file[:-len("_words")] for file in files if file.endswith("_words")]
+
+        if word_types:
+            with glovar.locks["regex"]:
+                compile_rules(word_types)
 
         # Send debug message
         text = (f"{lang('project')}{lang('colon')}{general_link(glovar.project_name, glovar.project_link)}\n"
@@ -817,8 +889,7 @@ def receive_user_score(project: str, data: dict) -> bool:
             return True
 
         score = data["score"]
-        glovar.user_ids[uid]["score"][project] = score
-        save("user_ids")
+        journal("user_ids", "set", (uid, "score", project), score)
 
         return True
     except Exception as e:
@@ -842,15 +913,11 @@ def receive_watch_user(data: dict) -> bool:
         until = get_int(until)
 
         # Add to list
-        if the_type == "ban":
-            glovar.watch_ids["ban"][uid] = until
-        elif the_type == "delete":
-            glovar.watch_ids["delete"][uid] = until
+        if the_type in {"ban", "delete"}:
+            journal("watch_ids", "set", (the_type, uid), until)
         else:
             return False
 
-        save("watch_ids")
-
         return True
     except Exception as e:
         logger.warning(f"Receive watch user error: {e}", exc_info=True)
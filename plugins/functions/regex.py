@@ -0,0 +1,1083 @@
+# SCP-079-CLEAN - Filter specific types of messages
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-CLEAN.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import re
+from collections import deque
+from hashlib import md5
+from json import dumps
+from queue import Empty, Queue
+from random import random
+from subprocess import PIPE, DEVNULL, Popen
+from sys import executable, getsizeof
+from time import perf_counter
+from typing import Any, Dict, FrozenSet, List, Match, Optional, Pattern, Set, Tuple
+
+from .. import glovar
+from .etc import thread
+from .file import save
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+# Enable logging
+logger = logging.getLogger(__name__)
+
+
+def charge_deadline() -> bool:
+    # Charge the time of the finished scan to the scanning time limit of the message
+    try:
+        start = getattr(glovar.regex_timer, "start", None)
+        glovar.regex_timer.start = None
+
+        if start is None or getattr(glovar.regex_timer, "left", None) is None:
+            return True
+
+        glovar.regex_timer.left -= perf_counter() - start
+
+        return True
+    except Exception as e:
+        logger.warning(f"Charge deadline error: {e}", exc_info=True)
+
+    return False
+
+
+def clear_cache(word_type: str) -> bool:
+    # Clear the cached verdicts of the word type
+    try:
+        with glovar.locks["cache"]:
+            for key in [k for k in glovar.regex_cache if k[0] == word_type]:
+                glovar.regex_cache_used -= glovar.regex_cache.pop(key)[2]
+
+        return True
+    except Exception as e:
+        logger.warning(f"Clear cache error: {e}", exc_info=True)
+
+    return False
+
+
+def compile_automaton(types: Dict[str, Dict[str, Any]]) -> Dict[str, list]:
+    # Build the literal automaton over the rules of all word types
+    result = {}
+
+    try:
+        literals: Dict[str, Set[Tuple[str, int]]] = {}
+
+        for word_type in types:
+            rules = types[word_type]["rules"]
+
+            for i in range(len(rules)):
+                for literal in rules[i]["literals"] or set():
+                    literals.setdefault(literal, set()).add((word_type, i))
+
+        result = get_automaton(literals)
+    except Exception as e:
+        logger.warning(f"Compile automaton error: {e}", exc_info=True)
+
+    return result
+
+
+def compile_group(types: Dict[str, Dict[str, Any]], word_types: List[str]) -> Dict[str, Any]:
+    # Combine the rules without required literals of several word types, tag each rule with its word type
+    result = {}
+
+    try:
+        rules = []
+        tags = []
+
+        for word_type in word_types:
+            for i in range(len(types[word_type]["rules"])):
+                rules.append(types[word_type]["rules"][i])
+                tags.append((word_type, i))
+
+        scans = {}
+
+        for ocr in (False, True):
+            for blind in (False, True):
+                indexes = [i for i in range(len(rules))
+                           if rules[i]["blind"] == blind and not (ocr and rules[i]["nocr"])]
+                scans[(ocr, blind)] = get_scans(rules, [i for i in indexes if not rules[i]["literals"]])
+
+        glovar.regex_version += 1
+
+        result = {
+            "word_types": word_types,
+            "tags": tags,
+            "scans": scans,
+            "version": glovar.regex_version
+        }
+    except Exception as e:
+        logger.warning(f"Compile group error: {e}", exc_info=True)
+
+    return result
+
+
+def compile_rule(word: str) -> Optional[Pattern]:
+    # Compile a single regex rule
+    result = None
+
+    try:
+        result = re.compile(word, re.I | re.S | re.M)
+    except Exception as e:
+        logger.warning(f"Compile rule {word} error: {e}", exc_info=True)
+
+    return result
+
+
+def compile_rules(word_types: List[str]) -> bool:
+    # Compile the rules of the word types, then publish a new snapshot to replace the old one
+    try:
+        types = dict(glovar.regex_rules.get("types", {}))
+
+        for word_type in word_types:
+            types[word_type] = get_compiled(word_type)
+
+        # The groups that include a changed word type are combined again
+        groups = dict(glovar.regex_rules.get("groups", {}))
+
+        for group in glovar.regex_groups:
+            members = [word_type for word_type in glovar.regex_groups[group] if word_type in types]
+
+            if group not in groups or set(members) & set(word_types):
+                groups[group] = compile_group(types, members)
+
+        # Readers get the rules and the automaton from the same snapshot, so they never take the lock
+        glovar.regex_rules = {
+            "types": types,
+            "automaton": compile_automaton(types),
+            "groups": groups
+        }
+
+        for word_type in word_types:
+            clear_cache(word_type)
+
+        return True
+    except Exception as e:
+        logger.warning(f"Compile rules error: {e}", exc_info=True)
+
+    return False
+
+
+def flush_count() -> bool:
+    # Flush the buffered rule hits into the word lists, save each changed list once
+    glovar.locks["count"].acquire()
+    try:
+        counts: Dict[str, Dict[str, int]] = {}
+
+        while glovar.regex_hits:
+            word_type, word = glovar.regex_hits.popleft()
+            counts.setdefault(word_type, {})
+            counts[word_type][word] = counts[word_type].get(word, 0) + 1
+
+        for word_type in counts:
+            words = eval(f"glovar.{word_type}_words")
+
+            scores = glovar.regex_scores.setdefault(word_type, {})
+
+            # The rule may have been removed by a new set
+            for word in counts[word_type]:
+                if word in words:
+                    words[word] = words[word] + counts[word_type][word]
+                    scores[word] = scores.get(word, 0) + counts[word_type][word]
+
+            save(f"{word_type}_words")
+
+        return True
+    except Exception as e:
+        logger.warning(f"Flush count error: {e}", exc_info=True)
+    finally:
+        glovar.locks["count"].release()
+
+    return False
+
+
+def get_automaton(literals: Dict[str, Set[Tuple[str, int]]]) -> Dict[str, list]:
+    # Get an Aho-Corasick automaton, the outputs of each state are the rules whose literals end there
+    result = {}
+
+    try:
+        goto: List[Dict[str, int]] = [{}]
+        fail: List[int] = [0]
+        out: List[Set[Tuple[str, int]]] = [set()]
+
+        # Trie
+        for literal in literals:
+            state = 0
+
+            for c in literal:
+                following = goto[state].get(c)
+
+                if following is None:
+                    goto.append({})
+                    fail.append(0)
+                    out.append(set())
+                    following = len(goto) - 1
+                    goto[state][c] = following
+
+                state = following
+
+            out[state] |= literals[literal]
+
+        # Failure links
+        queue = deque(goto[0].values())
+
+        while queue:
+            state = queue.popleft()
+
+            for c, following in goto[state].items():
+                queue.append(following)
+                f = fail[state]
+
+                while f and c not in goto[f]:
+                    f = fail[f]
+
+                fail[following] = goto[f].get(c, 0)
+                out[following] |= out[fail[following]]
+
+        result = {
+            "goto": goto,
+            "fail": fail,
+            "out": [frozenset(o) for o in out]
+        }
+    except Exception as e:
+        logger.warning(f"Get automaton error: {e}", exc_info=True)
+
+    return result
+
+
+def get_cache(key: tuple) -> Optional[tuple]:
+    # Get the cached verdict of the text
+    result = None
+
+    try:
+        with glovar.locks["cache"]:
+            result = glovar.regex_cache.get(key)
+
+            if result is not None:
+                glovar.regex_cache.move_to_end(key)
+    except Exception as e:
+        logger.warning(f"Get cache error: {e}", exc_info=True)
+
+    return result
+
+
+def get_candidates(grouped: Dict[str, Any], automaton: Dict[str, list], text: str,
+                   ocr: bool) -> Optional[Set[str]]:
+    # Get the word types of the group that may match the text, None if the scanning time is used up
+    result = set()
+    glovar.regex_timer.start = perf_counter()
+
+    try:
+        text = re.sub(r"\s{2,}", " ", text)
+        stripped = re.sub(r"\s", "", text) if " " in text else text
+        texts = [(text, False), (stripped, True)] + ([(stripped, False)] if stripped != text else [])
+
+        # A merged scan reports one rule, each word type of its rules may match
+        for t, blind in texts:
+            for scan in grouped["scans"][(ocr, blind)]:
+                if is_expired():
+                    return None
+
+                if not scan["pattern"].search(t):
+                    continue
+
+                indexes = scan["indexes"] if scan["index"] is None else [scan["index"]]
+                result |= {grouped["tags"][i][0] for i in indexes}
+
+        # Rules with required literals
+        word_types = set(grouped["word_types"])
+
+        for t in {text, stripped}:
+            result |= {word_type for word_type, _ in get_found(t, automaton) if word_type in word_types}
+    except Exception as e:
+        logger.warning(f"Get candidates error: {e}", exc_info=True)
+    finally:
+        charge_deadline()
+
+    return result
+
+
+def get_compiled(word_type: str) -> Dict[str, Any]:
+    # Get the compiled rules of the word type
+    result = {}
+
+    try:
+        # The rules with more recent hits run first
+        scores = glovar.regex_scores.get(word_type, {})
+        words = sorted(eval(f"glovar.{word_type}_words"), key=lambda w: -scores.get(w, 0))
+        rules: List[Dict[str, Any]] = []
+
+        # Reuse the rules of the current snapshot, they are never changed
+        store = glovar.regex_rules.get("types", {}).get(word_type, {})
+        compiled = {rule["word"]: rule for rule in store.get("rules", [])}
+
+        # Quarantined rules are never activated
+        slow = glovar.slow_rules.get(word_type, set())
+        words = [word for word in words if word not in slow]
+
+        for word in words:
+            if word in compiled:
+                rules.append(compiled[word])
+                continue
+
+            pattern = compile_rule(word)
+
+            if not pattern:
+                continue
+
+            rules.append(
+                {
+                    "word": word,
+                    "pattern": pattern,
+                    "nocr": "(?# nocr)" in word,
+                    "merge": is_mergeable(word),
+                    "blind": is_blind(word),
+                    "literals": get_literals(word)
+                }
+            )
+
+        # Split the rules by the ocr flag and whether the rule is whitespace blind
+        scans = {}
+        checks = {}
+
+        for ocr in (False, True):
+            for blind in (False, True):
+                indexes = [i for i in range(len(rules))
+                           if rules[i]["blind"] == blind and not (ocr and rules[i]["nocr"])]
+
+                # Rules with required literals only run when the automaton finds one of them
+                scans[(ocr, blind)] = get_scans(rules, [i for i in indexes if not rules[i]["literals"]])
+                checks[(ocr, blind)] = {i for i in indexes if rules[i]["literals"]}
+
+        glovar.regex_version += 1
+
+        result = {
+            "rules": rules,
+            "scans": scans,
+            "checks": checks,
+            "version": glovar.regex_version
+        }
+    except Exception as e:
+        logger.warning(f"Get compiled {word_type} error: {e}", exc_info=True)
+
+    return result
+
+
+def get_folded(text: str) -> str:
+    # Get the case folded text, as the literals are compared with IGNORECASE rules
+    # IGNORECASE lowers each character on its own, str.lower() expands the dotted I to two characters
+    result = ""
+
+    try:
+        result = text.replace("\u0130", "i").lower().translate(glovar.regex_fold)
+    except Exception as e:
+        logger.warning(f"Get folded error: {e}", exc_info=True)
+
+    return result
+
+
+def get_found(text: str, automaton: Dict[str, list]) -> FrozenSet[Tuple[str, int]]:
+    # Get the rules whose required literals appear in the text
+    result = frozenset()
+
+    try:
+        if not automaton or not automaton["goto"][0]:
+            return frozenset()
+
+        # Check the recent texts of this thread
+        cache = getattr(glovar.regex_found, "cache", None)
+
+        if cache is None or getattr(glovar.regex_found, "automaton", None) is not automaton:
+            glovar.regex_found.cache = cache = {}
+            glovar.regex_found.automaton = automaton
+
+        if text in cache:
+            return cache[text]
+
+        goto = automaton["goto"]
+        fail = automaton["fail"]
+        out = automaton["out"]
+        state = 0
+        found = set()
+
+        for c in get_folded(text):
+            while state and c not in goto[state]:
+                state = fail[state]
+
+            state = goto[state].get(c, 0)
+
+            if out[state]:
+                found |= out[state]
+
+        result = frozenset(found)
+
+        if len(cache) >= 8:
+            cache.clear()
+
+        cache[text] = result
+    except Exception as e:
+        logger.warning(f"Get found error: {e}", exc_info=True)
+
+    return result
+
+
+def get_key(word_type: str, text: str, ocr: bool, version: int) -> tuple:
+    # Get the cache key of the text
+    result = ()
+
+    try:
+        digest = md5(text.encode("utf-8", "surrogatepass")).digest()
+        result = (word_type, ocr, version, digest)
+    except Exception as e:
+        logger.warning(f"Get key error: {e}", exc_info=True)
+
+    return result
+
+
+def get_literals(word: str) -> Optional[FrozenSet[str]]:
+    # Get the literals that any match of the rule must contain one of them
+    result = None
+
+    try:
+        requirement = get_requirement(sre_parse.parse(word, re.I | re.S | re.M))
+
+        if requirement:
+            result = frozenset(get_folded(r) for r in requirement)
+    except Exception as e:
+        logger.info(f"Get literals {word} error: {e}", exc_info=True)
+
+    return result
+
+
+def get_requirement(items: Any) -> Optional[Set[str]]:
+    # Get the best literal requirement of a parsed pattern
+    result = None
+
+    try:
+        requirements = []
+        run = ""
+
+        for op, av in items:
+            name = str(op)
+
+            if name == "LITERAL":
+                run += chr(av)
+                continue
+
+            requirements.append(run and {run})
+            run = ""
+
+            if name == "SUBPATTERN":
+                requirements.append(get_requirement(av[-1]))
+            elif name == "ATOMIC_GROUP":
+                requirements.append(get_requirement(av))
+            elif name in {"MAX_REPEAT", "MIN_REPEAT", "POSSESSIVE_REPEAT"} and av[0] >= 1:
+                requirements.append(get_requirement(av[2]))
+            elif name == "BRANCH":
+                branches = [get_requirement(b) for b in av[1]]
+
+                if all(branches):
+                    requirements.append(set().union(*branches))
+
+        requirements.append(run and {run})
+
+        # Prefer the requirement with the longest shortest literal
+        requirements = [r for r in requirements if r and all(len(literal) >= 2 for literal in r)]
+
+        if requirements:
+            result = max(requirements, key=lambda r: (min(len(literal) for literal in r), -len(r)))
+    except Exception as e:
+        logger.info(f"Get requirement error: {e}", exc_info=True)
+
+    return result
+
+
+def get_scans(rules: List[Dict[str, Any]], indexes: List[int]) -> List[Dict[str, Any]]:
+    # Merge the rules into as few scans as possible, keep the original order
+    result = []
+
+    try:
+        chunk = []
+
+        for i in indexes:
+            if rules[i]["merge"] and len(chunk) < glovar.regex_chunk:
+                chunk.append(i)
+                continue
+
+            result += get_scans_merged(rules, chunk)
+            chunk = []
+
+            if rules[i]["merge"]:
+                chunk.append(i)
+            else:
+                result.append({"pattern": rules[i]["pattern"], "index": i})
+
+        result += get_scans_merged(rules, chunk)
+    except Exception as e:
+        logger.warning(f"Get scans error: {e}", exc_info=True)
+
+    return result
+
+
+def get_scans_merged(rules: List[Dict[str, Any]], indexes: List[int]) -> List[Dict[str, Any]]:
+    # Merge the rules into a single alternation, use named groups to find out the matched rule
+    result = []
+
+    try:
+        if not indexes:
+            return []
+
+        if len(indexes) == 1:
+            i = indexes[0]
+            return [{"pattern": rules[i]["pattern"], "index": i}]
+
+        word = "|".join(f"(?P<r{i}>{rules[i]['word']})" for i in indexes)
+        pattern = compile_rule(word)
+
+        if pattern:
+            result = [{"pattern": pattern, "index": None, "indexes": indexes}]
+        else:
+            result = [{"pattern": rules[i]["pattern"], "index": i} for i in indexes]
+    except Exception as e:
+        logger.warning(f"Get scans merged error: {e}", exc_info=True)
+
+    return result
+
+
+def get_slow(words: List[str]) -> Set[str]:
+    # Get the rules that exceed the time budget on the adversarial texts, check them in a process that can be killed
+    result = set()
+
+    try:
+        script = (
+            "import re, sys, json, time\n"
+            "budget = float(sys.argv[1])\n"
+            "for word in json.loads(sys.stdin.read()):\n"
+            "    start = time.perf_counter()\n"
+            "    try:\n"
+            "        pattern = re.compile(word, re.I | re.S | re.M)\n"
+            "        chars = sorted({c for c in word if c.isalnum()} | set('a1 .-_@\\n\\u4e2d'))\n"
+            "        texts = [c * 1000 + '!' for c in chars] + [(c + ' ') * 500 + '!' for c in chars]\n"
+            "        texts.append(''.join(chars) * 50 + '!')\n"
+            "        for text in texts:\n"
+            "            pattern.search(text)\n"
+            "            if time.perf_counter() - start > budget:\n"
+            "                break\n"
+            "    except Exception:\n"
+            "        pass\n"
+            "    print(time.perf_counter() - start, flush=True)\n"
+        )
+        pending = list(words)
+
+        # Define a reader function, so the output can be waited with a timeout
+        def read_lines(stdout: Any, lines: Queue) -> None:
+            for line in stdout:
+                lines.put(line)
+
+        while pending:
+            process = Popen([executable, "-c", script, str(glovar.regex_budget)],
+                            stdin=PIPE, stdout=PIPE, stderr=DEVNULL)
+            lines = Queue()
+            thread(read_lines, (process.stdout, lines))
+            process.stdin.write(dumps(pending).encode())
+            process.stdin.close()
+
+            # Give the first rule more time as the interpreter starts
+            checked = 0
+
+            try:
+                for word in pending:
+                    elapsed = float(lines.get(timeout=glovar.regex_budget + (checked and 1 or 5)))
+                    checked += 1
+
+                    if elapsed > glovar.regex_budget:
+                        result.add(word)
+            except Empty:
+                process.kill()
+                result.add(pending[checked])
+                checked += 1
+
+            process.wait()
+            pending = pending[checked:]
+    except Exception as e:
+        logger.warning(f"Get slow error: {e}", exc_info=True)
+
+    return result
+
+
+def get_snapshot(word_type: str) -> Dict[str, Any]:
+    # Get the current rules snapshot, which includes the word type
+    result = {}
+
+    try:
+        result = glovar.regex_rules
+
+        if word_type in result.get("types", {}):
+            return result
+
+        with glovar.locks["regex"]:
+            if word_type not in glovar.regex_rules.get("types", {}):
+                compile_rules([word_type])
+
+        result = glovar.regex_rules
+    except Exception as e:
+        logger.warning(f"Get snapshot {word_type} error: {e}", exc_info=True)
+
+    return result
+
+
+def init_rules() -> bool:
+    # Compile all rules loaded from the data files
+    glovar.locks["regex"].acquire()
+    try:
+        # Start with the counts since the last report
+        for word_type in glovar.regex:
+            glovar.regex_scores[word_type] = dict(eval(f"glovar.{word_type}_words"))
+
+        return compile_rules(list(glovar.regex))
+    except Exception as e:
+        logger.warning(f"Init rules error: {e}", exc_info=True)
+    finally:
+        glovar.locks["regex"].release()
+
+    return False
+
+
+def is_blind(word: str) -> bool:
+    # Check if the rule can not match any whitespace, so it matches the text with or without whitespace alike
+    result = False
+
+    try:
+        result = is_blind_items(sre_parse.parse(word, re.I | re.S | re.M))
+    except Exception as e:
+        logger.info(f"Is blind {word} error: {e}", exc_info=True)
+
+    return result
+
+
+def is_blind_items(items: Any) -> bool:
+    # Check if the parsed pattern can not match any whitespace, anchors and lookarounds depend on the context
+    try:
+        for op, av in items:
+            name = str(op)
+
+            if name == "LITERAL":
+                if chr(av) in glovar.regex_spaces:
+                    return False
+            elif name == "IN":
+                if not is_blind_set(av):
+                    return False
+            elif name == "SUBPATTERN":
+                if not is_blind_items(av[-1]):
+                    return False
+            elif name == "ATOMIC_GROUP":
+                if not is_blind_items(av):
+                    return False
+            elif name in {"MAX_REPEAT", "MIN_REPEAT", "POSSESSIVE_REPEAT"}:
+                if not is_blind_items(av[2]):
+                    return False
+            elif name == "BRANCH":
+                if not all(is_blind_items(b) for b in av[1]):
+                    return False
+            else:
+                return False
+
+        return True
+    except Exception as e:
+        logger.info(f"Is blind items error: {e}", exc_info=True)
+
+    return False
+
+
+def is_blind_set(items: Any) -> bool:
+    # Check if the character set can not match any whitespace
+    try:
+        for op, av in items:
+            name = str(op)
+
+            if name == "LITERAL":
+                if chr(av) in glovar.regex_spaces:
+                    return False
+            elif name in {"RANGE", "RANGE_UNI_IGNORE"}:
+                if any(av[0] <= ord(c) <= av[1] for c in glovar.regex_spaces):
+                    return False
+            elif name == "CATEGORY":
+                if str(av) not in {"CATEGORY_DIGIT", "CATEGORY_WORD", "CATEGORY_NOT_SPACE"}:
+                    return False
+            else:
+                return False
+
+        return True
+    except Exception as e:
+        logger.info(f"Is blind set error: {e}", exc_info=True)
+
+    return False
+
+
+def is_expired() -> bool:
+    # Check if the scanning time of the current message is used up, the running scan is included
+    try:
+        left = getattr(glovar.regex_timer, "left", None)
+
+        if left is None:
+            return False
+
+        start = glovar.regex_timer.start
+        spent = (start is not None and perf_counter() - start) or 0.0
+
+        if not glovar.regex_timer.expired and spent >= left:
+            glovar.regex_timer.expired = True
+
+        return glovar.regex_timer.expired
+    except Exception as e:
+        logger.warning(f"Is expired error: {e}", exc_info=True)
+
+    return False
+
+
+def is_mergeable(word: str) -> bool:
+    # Check if the rule can be merged with others without changing its meaning
+    try:
+        # Back references and conditions depend on the group numbers
+        if re.search(r"\\[1-9]|\(\?P=|\(\?\(", word):
+            return False
+
+        # Named groups may conflict with other rules
+        if "(?P<" in word:
+            return False
+
+        # Global flags must be at the start of the pattern
+        if re.search(r"\(\?[aiLmsux]+\)", word):
+            return False
+
+        return True
+    except Exception as e:
+        logger.warning(f"Is mergeable error: {e}", exc_info=True)
+
+    return False
+
+
+def match_group(group: str, text: str, ocr: bool = False) -> Dict[str, Tuple[Dict[str, Any], Match]]:
+    # Match the text with all word types of the group, return the matched rule and the match of each hit word type
+    result = {}
+
+    try:
+        snapshot = glovar.regex_rules
+        grouped = snapshot.get("groups", {}).get(group)
+
+        if not text or not grouped:
+            return {}
+
+        # Check the recent texts of this thread
+        ocr = bool(ocr)
+        key = (group, ocr, text)
+        cache = getattr(glovar.regex_grouped, "cache", None)
+
+        if cache is None or getattr(glovar.regex_grouped, "snapshot", None) is not snapshot:
+            glovar.regex_grouped.cache = cache = {}
+            glovar.regex_grouped.snapshot = snapshot
+
+        if key in cache:
+            return cache[key]
+
+        candidates = get_candidates(grouped, snapshot["automaton"], text, ocr)
+
+        if candidates is None:
+            return {}
+
+        # Only the word types that may match are checked on their own, the verdicts are cached
+        for word_type in grouped["word_types"]:
+            if word_type not in candidates:
+                continue
+
+            rule, matched = match_text(word_type, text, ocr)
+
+            if matched:
+                result[word_type] = (rule, matched)
+            elif is_expired():
+                return {}
+
+        if len(cache) >= 8:
+            cache.clear()
+
+        cache[key] = result
+    except Exception as e:
+        logger.warning(f"Match group {group} error: {e}", exc_info=True)
+
+    return result
+
+
+def match_rules(word_type: str, text: str, ocr: bool = False, blind: bool = False,
+                snapshot: Dict[str, Any] = None) -> Tuple[Optional[Dict[str, Any]], Optional[Match]]:
+    # Match the text with the whitespace aware or blind rules of the word type, return the matched rule and the match
+    # Only the time spent here is charged to the scanning time of the message
+    glovar.regex_timer.start = perf_counter()
+
+    try:
+        snapshot = snapshot or get_snapshot(word_type)
+        rules = snapshot.get("types", {}).get(word_type)
+
+        if not rules:
+            return None, None
+
+        group = (bool(ocr), blind)
+        index = None
+        result = None
+
+        # Rules without required literals
+        for scan in rules["scans"][group]:
+            if is_expired():
+                return None, None
+
+            result = scan["pattern"].search(text)
+
+            if not result:
+                continue
+
+            if scan["index"] is not None:
+                index = scan["index"]
+                break
+
+            # The alternation reports the leftmost match, an earlier rule may match further on
+            index = int(result.lastgroup[1:])
+
+            for i in scan["indexes"]:
+                if i >= index:
+                    break
+
+                if is_expired():
+                    return None, None
+
+                candidate = rules["rules"][i]["pattern"].search(text)
+
+                if candidate:
+                    index = i
+                    result = candidate
+                    break
+
+            break
+
+        # Rules whose required literals are found, keep the original order
+        checks = rules["checks"][group]
+        found = checks and get_found(text, snapshot["automaton"])
+        candidates = found and sorted(i for t, i in found if t == word_type and i in checks)
+
+        for i in candidates or []:
+            if index is not None and i > index:
+                break
+
+            if is_expired():
+                return None, None
+
+            candidate = rules["rules"][i]["pattern"].search(text)
+
+            if candidate:
+                index = i
+                result = candidate
+                break
+
+        if index is not None:
+            return rules["rules"][index], result
+    except Exception as e:
+        logger.warning(f"Match rules {word_type} error: {e}", exc_info=True)
+    finally:
+        charge_deadline()
+
+    return None, None
+
+
+def match_text(word_type: str, text: str, ocr: bool = False) -> Tuple[Optional[Dict[str, Any]], Optional[Match]]:
+    # Match the text with the rules of the word type, the verdicts of recent texts are cached
+    try:
+        snapshot = get_snapshot(word_type)
+        rules = snapshot.get("types", {}).get(word_type)
+
+        if not text or not rules:
+            return None, None
+
+        ocr = bool(ocr)
+        key = get_key(word_type, text, ocr, rules["version"])
+        cached = key and get_cache(key)
+
+        if cached:
+            return cached[0], cached[1]
+
+        # Collapse the whitespace, then try again without any whitespace
+        text = re.sub(r"\s{2,}", " ", text)
+        stripped = re.sub(r"\s", "", text) if " " in text else text
+        rule, result = match_rules(word_type, text, ocr, False, snapshot)
+
+        # The blind rules only need to match the text without whitespace
+        blind, blind_result = match_rules(word_type, stripped, ocr, True, snapshot)
+        order = rules["rules"].index
+
+        # Report the first rule in list order that matches the collapsed text, as a single pass would do
+        # A blind rule that matches the stripped text may still miss the collapsed one, so it is checked again
+        if blind_result and (not result or order(blind) < order(rule)):
+            if stripped == text:
+                rule, result = blind, blind_result
+            else:
+                candidate, candidate_result = blind, blind["pattern"].search(text)
+
+                if not candidate_result:
+                    candidate, candidate_result = match_rules(word_type, text, ocr, True, snapshot)
+
+                if candidate_result and (not result or order(candidate) < order(rule)):
+                    rule, result = candidate, candidate_result
+
+        # Otherwise report the first rule that matches the stripped text
+        if not result and stripped != text:
+            rule, result = match_rules(word_type, stripped, ocr, False, snapshot)
+
+            if blind_result and (not result or order(blind) < order(rule)):
+                rule, result = blind, blind_result
+
+        # Sample the cost of each rule
+        if glovar.regex_profile and random() * glovar.regex_sample < 1:
+            profile_rules(word_type, {text, stripped}, ocr, snapshot)
+
+        # The verdict is incomplete if the deadline of the message is exceeded
+        if not result and is_expired():
+            return None, None
+
+        key and set_cache(key, (rule, result))
+
+        return rule, result
+    except Exception as e:
+        logger.warning(f"Match text {word_type} error: {e}", exc_info=True)
+
+    return None, None
+
+
+def profile_rules(word_type: str, texts: Set[str], ocr: bool, snapshot: Dict[str, Any]) -> bool:
+    # Time each rule of the word type on the texts separately, record the cumulative time, calls and max time
+    try:
+        rules = snapshot["types"][word_type]["rules"]
+        costs = {}
+
+        for rule in rules:
+            if ocr and rule["nocr"]:
+                continue
+
+            for text in texts:
+                start = perf_counter()
+                rule["pattern"].search(text)
+                costs.setdefault(rule["word"], []).append(perf_counter() - start)
+
+        with glovar.locks["count"]:
+            records = glovar.regex_costs.setdefault(word_type, {})
+
+            for word in costs:
+                record = records.setdefault(word, {"time": 0.0, "calls": 0, "max": 0.0})
+                record["time"] += sum(costs[word])
+                record["calls"] += len(costs[word])
+                record["max"] = max(record["max"], *costs[word])
+
+        return True
+    except Exception as e:
+        logger.warning(f"Profile rules {word_type} error: {e}", exc_info=True)
+
+    return False
+
+
+def set_cache(key: tuple, value: tuple) -> bool:
+    # Cache the verdict of the text, evict the least recently used ones when the cache is full
+    try:
+        rule, result = value
+        size = getsizeof(key) + getsizeof(key[-1]) + (result and getsizeof(result.string) or 0)
+
+        with glovar.locks["cache"]:
+            if key in glovar.regex_cache:
+                return True
+
+            glovar.regex_cache[key] = (rule, result, size)
+            glovar.regex_cache_used += size
+
+            while (glovar.regex_cache
+                   and (len(glovar.regex_cache) > glovar.regex_cache_limit
+                        or glovar.regex_cache_used > glovar.regex_cache_memory)):
+                _, (_, _, evicted) = glovar.regex_cache.popitem(last=False)
+                glovar.regex_cache_used -= evicted
+
+        return True
+    except Exception as e:
+        logger.warning(f"Set cache error: {e}", exc_info=True)
+
+    return False
+
+
+def sort_rules() -> bool:
+    # Decay the hit scores, then recompile the word types whose rule order has changed
+    glovar.locks["regex"].acquire()
+    try:
+        with glovar.locks["count"]:
+            for word_type in list(glovar.regex_scores):
+                scores = glovar.regex_scores[word_type]
+                glovar.regex_scores[word_type] = {word: scores[word] * glovar.regex_decay for word in scores
+                                                  if scores[word] * glovar.regex_decay >= 0.01}
+
+        word_types = []
+        types = glovar.regex_rules.get("types", {})
+
+        for word_type in types:
+            scores = glovar.regex_scores.get(word_type, {})
+            words = [rule["word"] for rule in types[word_type]["rules"]]
+
+            if words != sorted(words, key=lambda w: -scores.get(w, 0)):
+                word_types.append(word_type)
+
+        word_types and compile_rules(word_types)
+
+        return True
+    except Exception as e:
+        logger.warning(f"Sort rules error: {e}", exc_info=True)
+    finally:
+        glovar.locks["regex"].release()
+
+    return False
+
+
+def start_deadline(secs: float) -> bool:
+    # Start the scanning time limit of the message handled by this thread
+    try:
+        glovar.regex_timer.left = secs
+        glovar.regex_timer.start = None
+        glovar.regex_timer.expired = False
+
+        return True
+    except Exception as e:
+        logger.warning(f"Start deadline error: {e}", exc_info=True)
+
+    return False
+
+
+def stop_deadline() -> bool:
+    # Stop the scanning deadline, return whether it was exceeded
+    result = False
+
+    try:
+        result = bool(getattr(glovar.regex_timer, "expired", False))
+        glovar.regex_timer.left = None
+        glovar.regex_timer.start = None
+        glovar.regex_timer.expired = False
+    except Exception as e:
+        logger.warning(f"Stop deadline error: {e}", exc_info=True)
+
+    return result
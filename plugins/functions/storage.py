@@ -0,0 +1,350 @@
+# SCP-079-CLEAN - Filter specific types of messages
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-CLEAN.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import sqlite3
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from os import remove, replace
+from os.path import exists
+from pickle import dumps, loads
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from .. import glovar
+
+# Enable logging
+logger = logging.getLogger(__name__)
+
+# Tables of the database
+schema = """
+    CREATE TABLE IF NOT EXISTS users (uid INTEGER PRIMARY KEY, score BLOB NOT NULL);
+    CREATE TABLE IF NOT EXISTS joins (uid INTEGER NOT NULL, gid INTEGER NOT NULL, time INTEGER NOT NULL,
+                                      PRIMARY KEY (uid, gid)) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS joins_time ON joins (time);
+    CREATE TABLE IF NOT EXISTS detections (uid INTEGER NOT NULL, gid INTEGER NOT NULL, time INTEGER NOT NULL,
+                                           PRIMARY KEY (uid, gid)) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS detections_time ON detections (time);
+    CREATE TABLE IF NOT EXISTS watches (type TEXT NOT NULL, uid INTEGER NOT NULL, until INTEGER NOT NULL,
+                                        PRIMARY KEY (type, uid)) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS watches_until ON watches (until);
+    CREATE TABLE IF NOT EXISTS configs (gid INTEGER PRIMARY KEY, config BLOB NOT NULL);
+"""
+
+
+class UserStore(MutableMapping):
+    # Read-through cache of the users table, changes are written by the journal flush
+    def __init__(self):
+        self.cache = OrderedDict()
+
+    def __delitem__(self, uid: int) -> None:
+        self.cache.pop(uid, None)
+
+    def __getitem__(self, uid: int) -> Dict[str, Dict[Any, Any]]:
+        status = self.cache.get(uid)
+
+        if status is not None:
+            self.cache.move_to_end(uid)
+            return status
+
+        status = load_user(uid)
+
+        if status is None:
+            raise KeyError(uid)
+
+        return self.cache.setdefault(uid, status)
+
+    def __iter__(self):
+        return iter(self.cache.keys() | get_uids())
+
+    def __len__(self) -> int:
+        return len(self.cache.keys() | get_uids())
+
+    def __setitem__(self, uid: int, status: Dict[str, Dict[Any, Any]]) -> None:
+        self.cache[uid] = status
+
+
+def clear_joins() -> bool:
+    # Remove the join times of all users with one statement, then reset the cached users
+    glovar.locks["storage"].acquire()
+
+    try:
+        user_ids = glovar.user_ids
+
+        # The users replaced as a whole are written by the next save
+        if not isinstance(user_ids, UserStore):
+            for uid in list(user_ids):
+                user_ids[uid]["join"] = {}
+
+            return True
+
+        for status in list(user_ids.cache.values()):
+            status["join"] = {}
+
+        with glovar.storage_db as db:
+            db.execute("DELETE FROM joins")
+
+        return True
+    except Exception as e:
+        logger.warning(f"Clear joins error: {e}", exc_info=True)
+    finally:
+        glovar.locks["storage"].release()
+
+    return False
+
+
+def execute(sql: str, parameters: tuple = ()) -> List[tuple]:
+    # Run a query on the database
+    result = []
+
+    glovar.locks["storage"].acquire()
+
+    try:
+        result = glovar.storage_db.execute(sql, parameters).fetchall()
+    except Exception as e:
+        logger.warning(f"Execute error: {e}", exc_info=True)
+    finally:
+        glovar.locks["storage"].release()
+
+    return result
+
+
+def get_expired(key: str, until: int, limit: int) -> List[Tuple[int, int, int]]:
+    # Get the join or detected rows that are older than until, the oldest first
+    table = {"detected": "detections", "join": "joins"}[key]
+
+    return execute(f"SELECT time, uid, gid FROM {table} WHERE time < ? ORDER BY time LIMIT ?", (until, limit))
+
+
+def get_storage_data(file: str) -> Any:
+    # Get a plain copy of a stored global variable
+    result = None
+
+    try:
+        if file != "user_ids":
+            return eval(f"glovar.{file}")
+
+        # User statuses are exported as plain dicts
+        if glovar.storage_backend != "sqlite":
+            return {uid: {"join": dict(status.get("join", {})),
+                          "detected": dict(status.get("detected", {})),
+                          "score": dict(status["score"])}
+                    for uid, status in list(glovar.user_ids.items())}
+
+        result = {uid: {"join": {}, "detected": {}, "score": loads(score)}
+                  for uid, score in execute("SELECT uid, score FROM users")}
+
+        for key, table in [("join", "joins"), ("detected", "detections")]:
+            for uid, gid, time in execute(f"SELECT uid, gid, time FROM {table}"):
+                if uid in result:
+                    result[uid][key][gid] = time
+    except Exception as e:
+        logger.warning(f"Get storage data error: {e}", exc_info=True)
+
+    return result
+
+
+def get_uids() -> Set[int]:
+    # Get all stored user ids
+    result = set()
+
+    try:
+        result = {uid for uid, in execute("SELECT uid FROM users")}
+    except Exception as e:
+        logger.warning(f"Get uids error: {e}", exc_info=True)
+
+    return result
+
+
+def init_storage() -> bool:
+    # Open the database, migrate the loaded pickles into it on the first run
+    try:
+        if glovar.storage_backend != "sqlite":
+            return True
+
+        if glovar.storage_migrate:
+            exists("data/.data.db") and remove("data/.data.db")
+            glovar.storage_db = sqlite3.connect("data/.data.db", check_same_thread=False)
+            glovar.storage_db.executescript(schema)
+
+            for file in glovar.storage_files:
+                if not save_storage(file):
+                    raise SystemExit(f"[MIGRATE {file.upper()} FAILED]")
+
+            glovar.storage_db.close()
+            replace("data/.data.db", "data/data.db")
+
+            # The journals are part of the database now
+            for file in glovar.storage_files:
+                exists(f"data/{file}.journal") and remove(f"data/{file}.journal")
+
+        glovar.storage_db = sqlite3.connect("data/data.db", check_same_thread=False)
+        glovar.storage_db.execute("PRAGMA journal_mode = WAL")
+        glovar.storage_db.execute("PRAGMA synchronous = NORMAL")
+        glovar.storage_db.executescript(schema)
+
+        # Load the small tables into memory
+        glovar.storage_configs = dict(execute("SELECT gid, config FROM configs"))
+        glovar.configs = {gid: loads(glovar.storage_configs[gid]) for gid in glovar.storage_configs}
+        glovar.watch_ids = {"ban": {}, "delete": {}}
+
+        for the_type, uid, until in execute("SELECT type, uid, until FROM watches"):
+            glovar.watch_ids.setdefault(the_type, {})[uid] = until
+
+        glovar.user_ids = UserStore()
+
+        return True
+    except Exception as e:
+        logger.critical(f"Init storage error: {e}", exc_info=True)
+        raise SystemExit("[DATA CORRUPTION]")
+
+
+def load_user(uid: int) -> Optional[glovar.UserStatus]:
+    # Load a user's status from the database
+    result = None
+
+    try:
+        score = execute("SELECT score FROM users WHERE uid = ?", (uid,))
+
+        if not score:
+            return None
+
+        result = glovar.UserStatus({
+            "join": dict(execute("SELECT gid, time FROM joins WHERE uid = ?", (uid,))),
+            "detected": dict(execute("SELECT gid, time FROM detections WHERE uid = ?", (uid,))),
+            "score": loads(score[0][0])
+        })
+    except Exception as e:
+        logger.warning(f"Load user {uid} error: {e}", exc_info=True)
+
+    return result
+
+
+def save_storage(file: str) -> bool:
+    # Write a whole global variable to the database in one transaction
+    glovar.locks["storage"].acquire()
+
+    try:
+        with glovar.storage_db as db:
+            if file == "configs":
+                configs = {gid: dumps(glovar.configs[gid]) for gid in list(glovar.configs)}
+                db.executemany("DELETE FROM configs WHERE gid = ?",
+                               [(gid,) for gid in glovar.storage_configs if gid not in configs])
+                db.executemany("INSERT OR REPLACE INTO configs (gid, config) VALUES (?, ?)",
+                               [(gid, configs[gid]) for gid in configs
+                                if glovar.storage_configs.get(gid) != configs[gid]])
+                glovar.storage_configs = configs
+            elif file == "watch_ids":
+                db.execute("DELETE FROM watches")
+                db.executemany("INSERT INTO watches (type, uid, until) VALUES (?, ?, ?)",
+                               [(the_type, uid, until) for the_type in list(glovar.watch_ids)
+                                for uid, until in list(glovar.watch_ids[the_type].items())])
+            elif file == "user_ids" and not isinstance(glovar.user_ids, UserStore):
+                # The users were replaced as a whole by a reset, a rollback or a migration
+                user_ids = glovar.user_ids
+
+                for table in ["users", "joins", "detections"]:
+                    db.execute(f"DELETE FROM {table}")
+
+                for uid in list(user_ids):
+                    write_user(db, uid, user_ids[uid])
+
+                glovar.user_ids = UserStore()
+
+        return True
+    except Exception as e:
+        logger.error(f"Save storage {file} error: {e}", exc_info=True)
+    finally:
+        glovar.locks["storage"].release()
+
+    return False
+
+
+def trim_storage() -> bool:
+    # Evict the least recently used users from the cache, only when no logged operation is pending
+    glovar.locks["journal"].acquire()
+
+    try:
+        if glovar.journal_ops or not isinstance(glovar.user_ids, UserStore):
+            return True
+
+        cache = glovar.user_ids.cache
+
+        while len(cache) > glovar.storage_cache:
+            cache.popitem(last=False)
+
+        return True
+    except Exception as e:
+        logger.warning(f"Trim storage error: {e}", exc_info=True)
+    finally:
+        glovar.locks["journal"].release()
+
+    return False
+
+
+def update_storage(file: str, operations: List[Tuple]) -> bool:
+    # Write the records changed by the logged operations in one transaction
+    glovar.locks["storage"].acquire()
+
+    try:
+        with glovar.storage_db as db:
+            if file == "user_ids":
+                user_ids = glovar.user_ids
+
+                for uid in {path[0] for _, path, _ in operations}:
+                    # Dirty users stay in the cache until they are written, a missing one was removed
+                    if isinstance(user_ids, UserStore):
+                        status = user_ids.cache.get(uid)
+                    else:
+                        status = user_ids.get(uid)
+
+                    write_user(db, uid, status)
+            elif file == "watch_ids":
+                for the_type, uid in {path for _, path, _ in operations}:
+                    until = glovar.watch_ids.get(the_type, {}).get(uid)
+
+                    if until is None:
+                        db.execute("DELETE FROM watches WHERE type = ? AND uid = ?", (the_type, uid))
+                    else:
+                        db.execute("INSERT OR REPLACE INTO watches (type, uid, until) VALUES (?, ?, ?)",
+                                   (the_type, uid, until))
+
+        return True
+    except Exception as e:
+        logger.error(f"Update storage {file} error: {e}", exc_info=True)
+    finally:
+        glovar.locks["storage"].release()
+
+    return False
+
+
+def write_user(db: sqlite3.Connection, uid: int, status: Optional[Dict[str, Dict[Any, Any]]]) -> bool:
+    # Replace a user's rows, remove them if the status is None
+    db.execute("DELETE FROM joins WHERE uid = ?", (uid,))
+    db.execute("DELETE FROM detections WHERE uid = ?", (uid,))
+
+    if status is None:
+        db.execute("DELETE FROM users WHERE uid = ?", (uid,))
+        return True
+
+    db.execute("INSERT OR REPLACE INTO users (uid, score) VALUES (?, ?)", (uid, dumps(dict(status["score"]))))
+    db.executemany("INSERT INTO joins (uid, gid, time) VALUES (?, ?, ?)",
+                   [(uid, gid, time) for gid, time in list(status["join"].items())])
+    db.executemany("INSERT INTO detections (uid, gid, time) VALUES (?, ?, ?)",
+                   [(uid, gid, time) for gid, time in list(status["detected"].items())])
+
+    return True
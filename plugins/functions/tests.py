@@ -18,15 +18,15 @@
 
 import logging
 import re
-from copy import deepcopy
 
 from pyrogram import Client, Message
 
 from .. import glovar
 from .channel import get_content
-from .etc import code, get_int, get_md5sum, get_text, lang, mention_id, thread
+from .etc import code, get_emoji_dict, get_int, get_md5sum, get_text, lang, mention_id, thread
 from .file import delete_file, get_downloaded_path
-from .filters import is_bmd, is_class_e, is_detected_url, is_emoji, is_exe, is_regex_text, is_tgl
+from .filters import count_ad_text, is_ad_text, is_bmd, is_class_e, is_detected_url, is_emoji, is_exe, is_regex_text
+from .filters import is_tgl
 from .image import get_file_id, get_qrcode
 from .telegram import send_message
 
@@ -65,7 +65,10 @@ def clean_test(client: Client, message: Message) -> bool:
             text += f"{lang('bmd')}{lang('colon')}{code('True')}\n"
 
         # AFF link
-        if is_regex_text("adi", message_text):
+        ad = is_ad_text(message_text, False)
+
+        if "i" in ad:
+            count_ad_text(ad, ["i"])
             text += f"{lang('aff')}{lang('colon')}{code('True')}\n"
 
         # Emoji
@@ -109,17 +112,7 @@ def clean_test(client: Client, message: Message) -> bool:
 
         # Show emoji
         emoji_text = get_text(message, False, False)
-        emoji_dict = {}
-        emoji_set = {emoji for emoji in glovar.emoji_set
-                     if emoji in emoji_text and emoji not in glovar.emoji_protect}
-        emoji_old_set = deepcopy(emoji_set)
-
-        for emoji in emoji_old_set:
-            if any(emoji in emoji_old and emoji != emoji_old for emoji_old in emoji_old_set):
-                emoji_set.discard(emoji)
-
-        for emoji in emoji_set:
-            emoji_dict[emoji] = emoji_text.count(emoji)
+        emoji_dict = get_emoji_dict(emoji_text)
 
         if emoji_dict:
             text += f"{lang('emoji_total')}{lang('colon')}{code(sum(emoji_dict.values()))}\n\n"
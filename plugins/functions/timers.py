@@ -17,18 +17,23 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-from copy import deepcopy
-from time import sleep
+from hashlib import sha256
+from pickle import dumps
 
 from pyrogram import Client
 from pyrogram.errors import FloodWait
 
 from .. import glovar
-from .channel import get_debug_text, share_data, share_regex_count
+from .channel import get_debug_text, share_data, share_data_thread, share_regex_cost, share_regex_count
+from .channel import update_score
 from .etc import code, general_link, get_now, lang, thread, wait_flood
-from .file import save
+from .file import data_to_archive, is_ready, journal, save
 from .filters import is_in_config
 from .group import leave_group
+from .ids import get_expired_times, init_expire_heaps, is_status_empty, is_time_indexed, reindex_user_time
+from .ids import reset_expire_heaps
+from .regex import flush_count
+from .storage import get_storage_data
 from .telegram import delete_messages, get_admins, get_chat_members_count, get_group_info, get_members, send_message
 from .user import kick_user, unban_user
 
@@ -37,23 +42,57 @@ logger = logging.getLogger(__name__)
 
 
 def backup_files(client: Client) -> bool:
-    # Backup data files to BACKUP
+    # Backup data files to BACKUP in one archive
     try:
+        # A full archive every week, otherwise only the files changed since the last full one
+        now = get_now()
+        full = now - glovar.backup_status["full"] >= 604800
+        hashes = {}
+        contents = {}
+
         for file in glovar.file_list:
             # Check
-            if not eval(f"glovar.{file}"):
+            if not is_ready(file) or not eval(f"glovar.{file}"):
                 continue
 
-            # Share
-            share_data(
-                client=client,
-                receivers=["BACKUP"],
-                action="backup",
-                action_type="data",
-                data=file,
-                file=f"data/{file}"
-            )
-            sleep(5)
+            # Export a plain pickle, the snapshots and the database are local formats
+            content = dumps(get_storage_data(file))
+            hashes[file] = sha256(content).hexdigest()
+
+            if full or glovar.backup_status["hashes"].get(file) != hashes[file]:
+                contents[file] = content
+
+        if not contents:
+            return True
+
+        manifest = {
+            "full": full,
+            "hashes": {file: hashes[file] for file in contents},
+            "time": now
+        }
+        file_path = data_to_archive(contents, manifest)
+
+        if not file_path:
+            return False
+
+        # Share, wait for the upload, the hashes only become the base of the next archives when it is sent
+        result = share_data_thread(
+            client=client,
+            receivers=["BACKUP"],
+            action="backup",
+            action_type="data",
+            data=(full and "archive_full") or "archive",
+            file=file_path
+        )
+
+        if not result or not full:
+            return result
+
+        glovar.backup_status = {
+            "full": now,
+            "hashes": hashes
+        }
+        save("backup_status")
 
         return True
     except Exception as e:
@@ -159,6 +198,48 @@ def clean_members(client: Client) -> bool:
     return False
 
 
+def expire_users(client: Client) -> bool:
+    # Drop the join and detected times that are out of every window, remove the users with no status left
+    # The message lock is not needed, each operation checks the current status under the journal lock
+    try:
+        if not is_ready("user_ids") or not init_expire_heaps():
+            return True
+
+        now = get_now()
+        untils = {
+            "detected": now - max(glovar.time_expire, glovar.time_punish),
+            "join": now - max(glovar.time_expire, glovar.time_new, glovar.time_short, glovar.time_track)
+        }
+        uids = set()
+        detected_uids = set()
+
+        for key in untils:
+            for time, uid, gid in get_expired_times(key, untils[key]):
+                # The time was updated after it was indexed, index the current one
+                if not journal("user_ids", "pop", (uid, key, gid), check=lambda: is_time_indexed(uid, key, gid, time)):
+                    reindex_user_time(uid, key, gid)
+                    continue
+
+                uids.add(uid)
+                key == "detected" and detected_uids.add(uid)
+
+        # The score of this bot is based on the detected times, it drops to zero with the last one
+        for uid in detected_uids:
+            status = glovar.user_ids.get(uid)
+
+            if status and not status.get("detected") and status["score"].get(glovar.sender.lower()):
+                update_score(client, uid)
+
+        for uid in uids:
+            journal("user_ids", "pop", (uid,), check=lambda: is_status_empty(uid))
+
+        return True
+    except Exception as e:
+        logger.warning(f"Expire users error: {e}", exc_info=True)
+
+    return False
+
+
 def interval_hour_01(client: Client) -> bool:
     # Execute every hour
     try:
@@ -176,19 +257,19 @@ def interval_hour_01(client: Client) -> bool:
                 glovar.message_ids[gid]["purge"] = (0, 0)
 
         # Delete stickers and animations in groups
-        with glovar.locks["message"]:
-            message_ids = deepcopy(glovar.message_ids)
-
         for gid in list(glovar.configs):
-            mid_dict = deepcopy(message_ids[gid]["stickers"])
-            mid_list = list(filter(lambda m: now - mid_dict[m] >= glovar.time_sticker, mid_dict))
+            mid_list = []
+
+            # The queue is ordered by time, only the expired front is touched
+            with glovar.locks["message"]:
+                stickers = glovar.message_ids[gid]["stickers"]
+
+                while stickers and now - stickers[0][1] >= glovar.time_sticker:
+                    mid_list.append(stickers.popleft()[0])
 
             if not mid_list:
                 continue
 
-            for mid in mid_list:
-                glovar.message_ids[gid]["stickers"].pop(mid, 0)
-
             if is_in_config(gid, "ttd"):
                 thread(delete_messages, (client, gid, mid_list))
                 count_text = f"{len(mid_list)} {lang('messages')}"
@@ -243,6 +324,7 @@ def reset_data(client: Client) -> bool:
         save("except_ids")
 
         glovar.user_ids = {}
+        reset_expire_heaps()
         save("user_ids")
 
         glovar.watch_ids = {
@@ -267,22 +349,29 @@ def reset_data(client: Client) -> bool:
 
 def send_count(client: Client) -> bool:
     # Send regex count to REGEX
-    glovar.locks["regex"].acquire()
     try:
-        for word_type in glovar.regex:
-            share_regex_count(client, word_type)
-            word_list = list(eval(f"glovar.{word_type}_words"))
-
-            for word in word_list:
-                eval(f"glovar.{word_type}_words")[word] = 0
-
+        flush_count()
+        counts = {}
+
+        # Replace the word lists with reset ones, then share the old ones without holding the lock
+        with glovar.locks["count"]:
+            for word_type in glovar.regex:
+                words = eval(f"glovar.{word_type}_words")
+                counts[word_type] = words
+                new_words = {word: 0 for word in words}
+                exec(f"glovar.{word_type}_words = new_words")
+
+            costs = glovar.regex_costs
+            glovar.regex_costs = {}
+
+        for word_type in counts:
+            share_regex_count(client, word_type, counts[word_type])
+            share_regex_cost(client, word_type, costs.get(word_type, {}))
             save(f"{word_type}_words")
 
         return True
     except Exception as e:
         logger.warning(f"Send count error: {e}", exc_info=True)
-    finally:
-        glovar.locks["regex"].release()
 
     return False
 
@@ -26,11 +26,11 @@ from .. import glovar
 from .etc import crypt_str, get_forward_name, get_full_name, get_now, lang, thread
 from .channel import ask_for_help, declare_message, forward_evidence, send_debug, share_bad_user
 from .channel import share_watch_user, update_score
-from .file import save
+from .file import journal, save
 from .group import delete_message
 from .filters import is_class_d, is_class_e_user, is_declared_message, is_detected_user, is_high_score_user
 from .filters import is_limited_user, is_new_user, is_watch_user, is_wb_text
-from .ids import init_user_id
+from .ids import init_user_id, set_user_time
 from .telegram import kick_chat_member, restrict_chat_member, unban_chat_member
 
 # Enable logging
@@ -61,7 +61,7 @@ def add_detected_user(gid: int, uid: int, now: int) -> bool:
             return False
 
         previous = glovar.user_ids[uid]["detected"].get(gid)
-        glovar.user_ids[uid]["detected"][gid] = now
+        set_user_time(uid, "detected", gid, now)
 
         return bool(previous)
     except Exception as e:
@@ -74,11 +74,10 @@ def add_watch_user(client: Client, the_type: str, uid: int, now: int) -> bool:
     # Add a watch ban user, share it
     try:
         until = now + glovar.time_ban
-        glovar.watch_ids[the_type][uid] = until
+        journal("watch_ids", "set", (the_type, uid), until)
         until = str(until)
         until = crypt_str("encrypt", until, glovar.key)
         share_watch_user(client, the_type, uid, until)
-        save("watch_ids")
 
         return True
     except Exception as e:
@@ -18,18 +18,28 @@
 
 import logging
 import pickle
+import re
 from codecs import getdecoder
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
+from hashlib import sha256
 from configparser import RawConfigParser
 from os import mkdir
 from os.path import exists
 from shutil import rmtree
 from string import ascii_lowercase
-from threading import Lock
-from typing import Dict, List, Set, Tuple, Union
+from threading import Event, Lock, local
+from typing import Any, Dict, List, Set, Tuple, Union
 
 from emoji import UNICODE_EMOJI
 from pyrogram import Chat, ChatMember
 
+# The characters that IGNORECASE treats as equal beyond their lowercase forms
+try:
+    from re._casefix import _EXTRA_CASES as extra_cases
+except ImportError:
+    from sre_compile import _ignorecase_fixes as extra_cases
+
 # Enable logging
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
@@ -71,6 +81,7 @@ test_group_id: int = 0
 # [custom]
 aio: Union[bool, str] = ""
 backup: Union[bool, str] = ""
+batch_receivers: Union[str, Set[str]] = ""
 date_reset: str = ""
 default_group_link: str = ""
 image_size: int = 0
@@ -79,8 +90,10 @@ limit_track: int = 0
 project_link: str = ""
 project_name: str = ""
 time_ban: int = 0
+time_expire: int = 2592000
 time_new: int = 0
 time_punish: int = 0
+time_save: int = 5
 time_short: int = 0
 time_sticker: int = 0
 time_track: int = 0
@@ -94,6 +107,16 @@ emoji_protect: [bytes, str] = "\\U0001F642"
 emoji_wb_single: int = 0
 emoji_wb_total: int = 0
 
+# [regex]
+regex_budget: float = 0.1
+regex_deadline: float = 1.0
+regex_profile: Union[bool, str] = "False"
+regex_sample: int = 100
+
+# [storage]
+storage_backend: str = "pickle"
+storage_cache: int = 100000
+
 # [encrypt]
 key: Union[bytes, str] = ""
 password: str = ""
@@ -133,6 +156,8 @@ try:
     aio = eval(aio)
     backup = config["custom"].get("backup", backup)
     backup = eval(backup)
+    batch_receivers = config["custom"].get("batch_receivers", batch_receivers)
+    batch_receivers = {r.upper() for r in batch_receivers.split()}
     date_reset = config["custom"].get("date_reset", date_reset)
     default_group_link = config["custom"].get("default_group_link", default_group_link)
     image_size = int(config["custom"].get("image_size", str(image_size)))
@@ -143,8 +168,10 @@ try:
     project_link = config["custom"].get("project_link", project_link)
     project_name = config["custom"].get("project_name", project_name)
     time_ban = int(config["custom"].get("time_ban", str(time_ban)))
+    time_expire = int(config["custom"].get("time_expire", str(time_expire)))
     time_new = int(config["custom"].get("time_new", str(time_new)))
     time_punish = int(config["custom"].get("time_punish", str(time_punish)))
+    time_save = int(config["custom"].get("time_save", str(time_save)))
     time_short = int(config["custom"].get("time_short", str(time_short)))
     time_sticker = int(config["custom"].get("time_sticker", str(time_sticker)))
     time_track = int(config["custom"].get("time_track", str(time_track)))
@@ -160,6 +187,17 @@ try:
     emoji_wb_single = int(config.get("emoji", "emoji_wb_single", fallback=emoji_wb_single))
     emoji_wb_total = int(config.get("emoji", "emoji_wb_total", fallback=emoji_wb_total))
 
+    # [regex]
+    regex_budget = float(config.get("regex", "regex_budget", fallback=regex_budget))
+    regex_deadline = float(config.get("regex", "regex_deadline", fallback=regex_deadline))
+    regex_profile = config.get("regex", "regex_profile", fallback=regex_profile)
+    regex_profile = eval(regex_profile)
+    regex_sample = int(config.get("regex", "regex_sample", fallback=regex_sample))
+
+    # [storage]
+    storage_backend = config.get("storage", "storage_backend", fallback=storage_backend)
+    storage_cache = int(config.get("storage", "storage_cache", fallback=storage_cache))
+
     # [encrypt]
     key = config["encrypt"].get("key", key)
     key = key.encode("utf-8")
@@ -197,8 +235,10 @@ if (bot_token in {"", "[DATA EXPUNGED]"}
         or project_link in {"", "[DATA EXPUNGED]"}
         or project_name in {"", "[DATA EXPUNGED]"}
         or time_ban == 0
+        or time_expire <= 0
         or time_new == 0
         or time_punish == 0
+        or time_save <= 0
         or time_short == 0
         or time_sticker == 0
         or time_track == 0
@@ -209,6 +249,12 @@ if (bot_token in {"", "[DATA EXPUNGED]"}
         or emoji_protect in {"", "[DATA EXPUNGED]"}
         or emoji_wb_single == 0
         or emoji_wb_total == 0
+        or regex_budget <= 0
+        or regex_deadline <= 0
+        or regex_profile not in {False, True}
+        or regex_sample == 0
+        or storage_backend not in {"pickle", "sqlite"}
+        or storage_cache <= 0
         or key in {b"", b"[DATA EXPUNGED]", "", "[DATA EXPUNGED]"}
         or password in {"", "[DATA EXPUNGED]"}):
     logger.critical("No proper settings")
@@ -371,6 +417,8 @@ lang: Dict[str, str] = {
     "record_link": (zh_cn and "过滤链接") or "Recorded link",
     "white_listed": (zh_cn and "白名单") or "White Listed",
     "emoji_total": (zh_cn and "Emoji 总数") or "Total Emoji Characters",
+    "regex_cost": (zh_cn and "规则耗时") or "Rule Cost",
+    "regex_cost_format": (zh_cn and "总耗时 / 次数 / 最长耗时") or "Total / Calls / Max",
     # Unit
     "members": (zh_cn and "名") or "member(s)",
     "messages": (zh_cn and "条") or "message(s)"
@@ -382,6 +430,7 @@ all_commands: List[str] = [
     "clean",
     "config",
     "config_clean",
+    "cost",
     "dafm",
     "purge",
     "purge_begin",
@@ -454,36 +503,161 @@ default_config: Dict[str, Union[bool, int]] = {
     "dic": False
 }
 
-default_message_data: Dict[str, Union[int, Dict[int, int], Tuple[int, int]]] = {
+default_message_data: Dict[str, Union[int, deque, Tuple[int, int]]] = {
     "purge": (0, 0),
     "service": 0,
-    "stickers": {}
+    "stickers": deque()
 }
 
-default_user_status: Dict[str, Dict[Union[int, str], Union[float, int]]] = {
-    "detected": {},
-    "join": {},
-    "score": {
-        "captcha": 0.0,
-        "clean": 0.0,
-        "lang": 0.0,
-        "long": 0.0,
-        "noflood": 0.0,
-        "noporn": 0.0,
-        "nospam": 0.0,
-        "recheck": 0.0,
-        "warn": 0.0
-    }
-}
+default_user_scores: Tuple[str, ...] = ("captcha", "clean", "lang", "long", "noflood", "noporn", "nospam",
+                                         "recheck", "warn")
+
+
+class UserScore(MutableMapping):
+    # Score view of a user's status, the default projects are slots of the status, others are kept in a dict
+    __slots__ = ("status",)
+
+    def __init__(self, status: "UserStatus"):
+        self.status = status
+
+    def __delitem__(self, project: str) -> None:
+        if project in default_user_scores:
+            setattr(self.status, project, 0.0)
+        else:
+            del (self.status.extra or {})[project]
+
+    def __getitem__(self, project: str) -> float:
+        if project in default_user_scores:
+            return getattr(self.status, project)
+
+        return (self.status.extra or {})[project]
+
+    def __iter__(self):
+        return iter(default_user_scores + tuple(self.status.extra or ()))
+
+    def __len__(self) -> int:
+        return len(default_user_scores) + len(self.status.extra or ())
+
+    def __setitem__(self, project: str, score: float) -> None:
+        if project in default_user_scores:
+            setattr(self.status, project, score)
+        else:
+            self.status.extra = self.status.extra or {}
+            self.status.extra[project] = score
+
+
+class UserStatus:
+    # Status of a user, the join and detected dicts are only kept when they are not empty
+    __slots__ = ("join_ids", "detected_ids", "extra") + default_user_scores
+
+    def __init__(self, status: Dict[str, Dict[Union[int, str], Union[float, int]]] = None):
+        self.join_ids = None
+        self.detected_ids = None
+        self.extra = None
+
+        for project in default_user_scores:
+            setattr(self, project, 0.0)
+
+        # Convert a status dict written by an older version
+        for key in (status or {}):
+            self[key] = status[key]
+
+    def __getitem__(self, key: str) -> Union[Dict[int, int], UserScore]:
+        if key == "score":
+            return UserScore(self)
+
+        if key not in {"detected", "join"}:
+            raise KeyError(key)
+
+        if getattr(self, f"{key}_ids") is None:
+            setattr(self, f"{key}_ids", {})
+
+        return getattr(self, f"{key}_ids")
+
+    def __getstate__(self) -> tuple:
+        return tuple((getattr(self, name) or None) if name in {"join_ids", "detected_ids", "extra"}
+                     else getattr(self, name) for name in self.__slots__)
+
+    def __setitem__(self, key: str, value: Union[Dict[int, int], Dict[str, float]]) -> None:
+        if key == "score":
+            for project in value:
+                self["score"][project] = value[project]
+        elif key in {"detected", "join"}:
+            setattr(self, f"{key}_ids", value or None)
+        else:
+            raise KeyError(key)
+
+    def __setstate__(self, state: tuple) -> None:
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        # Reading an unused join or detected dict does not create it
+        if key in {"detected", "join"}:
+            value = getattr(self, f"{key}_ids")
+            return default if value is None else value
+
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
 
 emoji_set: Set[str] = set(UNICODE_EMOJI)
 
+emoji_trie: Dict[str, dict] = {}
+# emoji_trie = {
+#     "\U0001F468": {
+#         "": "\U0001F468",
+#         "\u200d": {
+#             "\U0001F4BB": {
+#                 "": "\U0001F468\u200d\U0001F4BB"
+#             }
+#         }
+#     }
+# }
+
+for emoji in emoji_set:
+    if emoji in emoji_protect:
+        continue
+
+    node = emoji_trie
+
+    for c in emoji:
+        node = node.setdefault(c, {})
+
+    node[""] = emoji
+
+expire_built: bool = False
+
+expire_heaps: Dict[str, List[Tuple[int, int, int]]] = {
+    "detected": [],
+    "join": []
+}
+# expire_heaps = {
+#     "detected": [(1512345678, 12345678, -10012345678)],
+#     "join": [(1512345678, 12345678, -10012345678)]
+# }
+
+journal_files: List[str] = ["user_ids", "watch_ids"]
+
+journal_ops: deque = deque()
+# journal_ops = deque([("user_ids", ("set", (12345678, "join", -10012345678), 1512345678))])
+
 locks: Dict[str, Lock] = {
     "admin": Lock(),
+    "cache": Lock(),
     "config": Lock(),
+    "count": Lock(),
+    "expire": Lock(),
+    "journal": Lock(),
     "message": Lock(),
     "receive": Lock(),
     "regex": Lock(),
+    "save": Lock(),
+    "share": Lock(),
+    "storage": Lock(),
+    "t2s": Lock(),
     "test": Lock(),
     "text": Lock()
 }
@@ -495,6 +669,13 @@ members: Dict[int, Dict[int, ChatMember]] = {}
 #     }
 # }
 
+message_views: local = local()
+# message_views.views = {
+#     (-10012345678, 123, 1512345678, None): {
+#         ("text", True, True): "text"
+#     }
+# }
+
 other_commands: Set[str] = {
     "admin",
     "admins",
@@ -596,10 +777,191 @@ for c in ascii_lowercase:
 
 regex["adi"] = True
 
+regex_cache: OrderedDict = OrderedDict()
+# regex_cache = OrderedDict({
+#     ("ad", False, 1, b"md5 digest"): (None, None, 200)
+# })
+
+regex_cache_limit: int = 10000
+
+regex_cache_memory: int = 16 * 1024 * 1024
+
+regex_cache_used: int = 0
+
+regex_chunk: int = 100
+
+regex_costs: Dict[str, Dict[str, Dict[str, Union[float, int]]]] = {}
+# regex_costs = {
+#     "ad": {
+#         "regex": {
+#             "time": 0.0012,
+#             "calls": 3,
+#             "max": 0.0008
+#         }
+#     }
+# }
+
+regex_decay: float = 0.8
+
+regex_fold: Dict[int, str] = {c: chr(min(c, *extra_cases[c])) for c in extra_cases
+                               if min(c, *extra_cases[c]) != c}
+# regex_fold = {
+#     0x131: "i",
+#     0x1c80: "\u0432"
+# }
+
+regex_found: local = local()
+# regex_found.cache = {
+#     "text": frozenset({("ad", 0)})
+# }
+
+regex_groups: Dict[str, List[str]] = {
+    "ad": [f"ad{c}" for c in ascii_lowercase]
+}
+
+regex_grouped: local = local()
+# regex_grouped.cache = {
+#     ("ad", False, "text"): {
+#         "adb": (rule, match)
+#     }
+# }
+
+regex_hits: deque = deque()
+# regex_hits = deque([("ad", "regex")])
+
+regex_rescan: int = 60
+
+regex_rules: Dict[str, Union[Dict[str, Dict[str, Any]], Dict[str, list]]] = {}
+# regex_rules = {
+#     "types": {
+#         "ad": {
+#             "rules": [
+#                 {
+#                     "word": "regex",
+#                     "pattern": re.compile("regex", re.I | re.S | re.M),
+#                     "nocr": False,
+#                     "merge": True,
+#                     "blind": True,
+#                     "literals": frozenset({"regex"})
+#                 },
+#                 {
+#                     "word": "[0-9]{5}",
+#                     "pattern": re.compile("[0-9]{5}", re.I | re.S | re.M),
+#                     "nocr": False,
+#                     "merge": True,
+#                     "blind": True,
+#                     "literals": None
+#                 }
+#             ],
+#             "scans": {
+#                 (False, False): [],
+#                 (False, True): [
+#                     {
+#                         "pattern": re.compile("[0-9]{5}", re.I | re.S | re.M),
+#                         "index": 1
+#                     }
+#                 ],
+#                 (True, False): [],
+#                 (True, True): []
+#             },
+#             "checks": {
+#                 (False, False): set(),
+#                 (False, True): {0},
+#                 (True, False): set(),
+#                 (True, True): {0}
+#             },
+#             "version": 1
+#         }
+#     },
+#     "automaton": {
+#         "goto": [{"r": 1}, {"e": 2}, {"g": 3}, {"e": 4}, {"x": 5}, {}],
+#         "fail": [0, 0, 0, 0, 0, 0],
+#         "out": [frozenset(), frozenset(), frozenset(), frozenset(), frozenset(), frozenset({("ad", 0)})]
+#     },
+#     "groups": {
+#         "ad": {
+#             "word_types": ["ada", "adb"],
+#             "tags": [("ada", 0), ("adb", 0)],
+#             "scans": {
+#                 (False, False): [
+#                     {
+#                         "pattern": re.compile("(?P<r0>[0-9]{5})|(?P<r1>[a-z]{9})", re.I | re.S | re.M),
+#                         "index": None,
+#                         "indexes": [0, 1]
+#                     }
+#                 ]
+#             },
+#             "version": 3
+#         }
+#     }
+# }
+
+regex_scores: Dict[str, Dict[str, float]] = {}
+# regex_scores = {
+#     "ad": {
+#         "regex": 3.2
+#     }
+# }
+
+regex_spaces: str = "".join(chr(i) for i in range(0x3001) if re.match(r"\s", chr(i)))
+
+regex_timer: local = local()
+# regex_timer.left = 0.75
+# regex_timer.start = 12345.678
+# regex_timer.expired = False
+
+regex_version: int = 0
+
+save_dirty: Set[str] = set()
+# save_dirty = {"user_ids"}
+
+save_generations: Dict[str, int] = {}
+# save_generations = {
+#     "user_ids": 12
+# }
+
+save_magic: bytes = b"SCP-079-SNAPSHOT"
+
 sender: str = "CLEAN"
 
+share_batches: Dict[Tuple[Tuple[str, ...], str, str], List[Union[dict, int, str]]] = {}
+# share_batches = {
+#     (("CAPTCHA", "LANG", "LONG"), "update", "declare"): [
+#         {
+#             "group_id": -10012345678,
+#             "message_id": 123
+#         }
+#     ]
+# }
+
+share_limit: int = 20
+
 should_hide: bool = False
 
+storage_configs: Dict[int, bytes] = {}
+# storage_configs = {
+#     -10012345678: b"pickled config"
+# }
+
+storage_db: Any = None
+# storage_db = sqlite3.connect("data/data.db")
+
+storage_files: List[str] = ["configs", "user_ids", "watch_ids"]
+
+storage_migrate: bool = storage_backend == "sqlite" and not exists("data/data.db")
+
+t2s_cache: OrderedDict = OrderedDict()
+# t2s_cache = OrderedDict({
+#     "繁體": "繁体"
+# })
+
+t2s_cache_length: int = 64
+
+t2s_cache_limit: int = 10000
+
+t2s_converter: Any = None
+# t2s_converter = OpenCC("t2s.json")
+
 types: Dict[str, Union[List[str], Set[str]]] = {
     "all": ["con", "loc", "vdn", "voi",
             "ast", "aud", "bmd", "doc", "gam", "gif", "via", "vid", "ser", "sti",
@@ -665,15 +1027,12 @@ flooded_ids: Set[int] = set()
 left_group_ids: Set[int] = set()
 # left_group_ids = {-10012345678}
 
-message_ids: Dict[int, Dict[str, Union[int, Dict[int, int], Tuple[int, int]]]] = {}
+message_ids: Dict[int, Dict[str, Union[int, deque, Tuple[int, int]]]] = {}
 # message_ids = {
 #     -10012345678: {
 #         "purge": (123, 1512345678)
 #         "service": 123,
-#         "stickers": {
-#             456: 1512345678,
-#             789: 1512346678
-#         }
+#         "stickers": deque([(456, 1512345678), (789, 1512346678)])
 #     }
 # }
 
@@ -682,9 +1041,9 @@ trust_ids: Dict[int, Set[int]] = {}
 #     -10012345678: {12345678}
 # }
 
-user_ids: Dict[int, Dict[str, Dict[Union[int, str], Union[float, int]]]] = {}
+user_ids: Dict[int, UserStatus] = {}
 # user_ids = {
-#     12345678: {
+#     12345678: UserStatus({
 #         "detected": {
 #               -10012345678: 1512345678
 #         },
@@ -702,7 +1061,7 @@ user_ids: Dict[int, Dict[str, Dict[Union[int, str], Union[float, int]]]] = {}
 #             "recheck": 0.0,
 #             "warn": 0.0
 #         }
-#     }
+#     })
 # }
 
 watch_ids: Dict[str, Dict[int, int]] = {
@@ -761,6 +1120,11 @@ configs: Dict[int, Dict[str, Union[bool, int]]] = {}
 #     }
 # }
 
+slow_rules: Dict[str, Set[str]] = {}
+# slow_rules = {
+#     "ad": {"(a+)+$"}
+# }
+
 # Init word variables
 
 for word_type in regex:
@@ -770,30 +1134,117 @@ for word_type in regex:
 #     "regex": 0
 # }
 
+# Init backup variables
+
+backup_status: Dict[str, Union[int, Dict[str, str]]] = {
+    "full": 0,
+    "hashes": {}
+}
+# backup_status = {
+#     "full": 1512345678,
+#     "hashes": {
+#         "user_ids": "sha256 of the exported pickle"
+#     }
+# }
+
 # Load data
 file_list: List[str] = ["admin_ids", "bad_ids", "except_ids", "flooded_ids", "left_group_ids",
                         "message_ids", "trust_ids", "user_ids", "watch_ids", "white_ids",
-                        "configs"]
+                        "configs", "slow_rules"]
 file_list += [f"{f}_words" for f in regex]
 
-for file in file_list:
-    try:
+
+def convert_data(file: str, data: Any) -> Any:
+    # Convert the data written by an older version
+    # User status dicts become UserStatus records
+    if file == "user_ids":
+        for uid in data:
+            if isinstance(data[uid], dict):
+                data[uid] = UserStatus(data[uid])
+
+    # Sticker dicts become time-ordered queues
+    if file == "message_ids":
+        for gid in data:
+            stickers = data[gid].get("stickers", {})
+
+            if isinstance(stickers, dict):
+                data[gid]["stickers"] = deque(sorted(stickers.items(), key=lambda s: s[1]))
+
+    return data
+
+
+def load_data(file: str) -> bool:
+    # Load a global variable from the newest good snapshot
+    # Snapshot: magic, 8 bytes generation, 32 bytes SHA-256 of the pickle, pickle
+    # A snapshot without the magic is a plain pickle written by an older version
+    header = len(save_magic)
+    snapshots = []
+
+    # Only read the headers to order the snapshots
+    for path in [f"data/{file}", f"data/.{file}", f"data/{file}.tmp"]:
+        if not exists(path):
+            continue
+
         try:
-            if exists(f"data/{file}") or exists(f"data/.{file}"):
-                with open(f"data/{file}", "rb") as f:
-                    locals()[f"{file}"] = pickle.load(f)
+            with open(path, "rb") as f:
+                head = f.read(header + 40)
+
+            if head.startswith(save_magic):
+                snapshots.append((int.from_bytes(head[header:header + 8], "big"), path))
             else:
-                with open(f"data/{file}", "wb") as f:
-                    pickle.dump(eval(f"{file}"), f)
+                snapshots.append((-1, path))
+        except Exception as e:
+            logger.error(f"Load data {path} error: {e}", exc_info=True)
+
+    # Read and verify one snapshot at a time, the newest generation first, so only one copy is in memory
+    for generation, path in sorted(snapshots, key=lambda s: s[0], reverse=True):
+        try:
+            with open(path, "rb") as f:
+                content = memoryview(f.read())
+
+            if generation >= 0:
+                digest = content[header + 8:header + 40]
+                content = content[header + 40:]
+
+                if sha256(content).digest() != digest:
+                    raise ValueError("checksum mismatch")
+
+            globals()[file] = convert_data(file, pickle.loads(content))
+            save_generations[file] = max(generation, 0)
+            return True
         except Exception as e:
-            logger.error(f"Load data {file} error: {e}", exc_info=True)
+            logger.error(f"Load data {path} error: {e}", exc_info=True)
+
+    if snapshots:
+        logger.critical(f"Load data {file} backup error: no good generation")
+        return False
+
+    return True
+
+
+# Large files are loaded in the background, the others before the client starts
+lazy_files: List[str] = (storage_backend == "pickle" and ["user_ids"]) or []
 
-            with open(f"data/.{file}", "rb") as f:
-                locals()[f"{file}"] = pickle.load(f)
-    except Exception as e:
-        logger.critical(f"Load data {file} backup error: {e}", exc_info=True)
+# Operations logged while a large file is loading, they are applied again to the loaded data
+lazy_pending: Dict[str, List[tuple]] = {file: [] for file in lazy_files}
+
+lazy_ready: Dict[str, Event] = {file: Event() for file in lazy_files}
+
+for file in file_list:
+    # The database holds these files, they are opened by init_storage()
+    if storage_backend == "sqlite" and not storage_migrate and file in storage_files:
+        continue
+
+    if file in lazy_files:
+        continue
+
+    if not load_data(file):
         raise SystemExit("[DATA CORRUPTION]")
 
+# The backup status is kept apart, it is not backed up itself
+if not load_data("backup_status"):
+    raise SystemExit("[DATA CORRUPTION]")
+
 # Generate special characters dictionary
 for special in ["spc", "spe"]:
     locals()[f"{special}_dict"]: Dict[str, str] = {}
@@ -813,6 +1264,12 @@ for special in ["spc", "spe"]:
         for k in keys:
             locals()[f"{special}_dict"][k] = value
 
+# Generate special characters translation table, spc first, then spe
+special_table: Dict[int, str] = {
+    ord(k): spe_dict.get(spc_dict.get(k, k), spc_dict.get(k, k))
+    for k in set(spc_dict) | set(spe_dict)
+}
+
 # Start program
 copyright_text = (f"SCP-079-{sender} v{version}, Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>\n"
                   "Licensed under the terms of the GNU General Public License v3 or later (GPLv3+)\n")
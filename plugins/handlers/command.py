@@ -77,13 +77,10 @@ def clean(client: Client, message: Message) -> bool:
         glovar.cleaned_ids.add(gid)
 
         with glovar.locks["message"]:
-            mids = deepcopy(glovar.message_ids[gid]["stickers"])
+            mids = [sticker_mid for sticker_mid, _ in glovar.message_ids[gid]["stickers"]]
+            glovar.message_ids[gid]["stickers"].clear()
 
         thread(delete_messages, (client, gid, mids))
-
-        for sticker_mid in mids:
-            glovar.message_ids[gid]["stickers"].pop(sticker_mid, 0)
-
         save("message_ids")
 
         # Generate the report message's text
@@ -282,6 +279,50 @@ def config_directly(client: Client, message: Message) -> bool:
     return False
 
 
+@Client.on_message(Filters.incoming & Filters.group & Filters.command(["cost"], glovar.prefix)
+                   & test_group
+                   & from_user)
+def cost(client: Client, message: Message) -> bool:
+    # Show the most expensive regex rules
+    result = False
+
+    try:
+        # Basic data
+        cid = message.chat.id
+        aid = message.from_user.id
+        mid = message.message_id
+
+        # Get command type
+        command_type = get_command_type(message)
+
+        # Generate the text
+        text = f"{lang('admin')}{lang('colon')}{mention_id(aid)}\n\n"
+
+        if glovar.regex_profile:
+            costs = [(word_type, word, record)
+                     for word_type, records in list(glovar.regex_costs.items())
+                     if not command_type or word_type == command_type
+                     for word, record in list(records.items())]
+            costs = sorted(costs, key=lambda c: c[2]["time"], reverse=True)[:10]
+            text += f"{lang('regex_cost')}{lang('colon')}{code(lang('regex_cost_format'))}\n\n"
+        else:
+            costs = []
+            text += f"{lang('regex_cost')}{lang('colon')}{code(lang('disabled'))}\n"
+
+        for word_type, word, record in costs:
+            total = f"{record['time']:.3f}s"
+            longest = f"{record['max'] * 1000:.1f}ms"
+            text += f"{code(word_type)}    {code(word)}\n"
+            text += "\t" * 4 + f"{code(total)} / {code(record['calls'])} / {code(longest)}\n"
+
+        # Send the report message
+        result = send_message(client, cid, text, mid)
+    except Exception as e:
+        logger.warning(f"Cost error: {e}", exc_info=True)
+
+    return result
+
+
 @Client.on_message(Filters.incoming & Filters.group & Filters.command(["dafm"], glovar.prefix)
                    & ~test_group & authorized_group
                    & from_user)
@@ -17,6 +17,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+from typing import List, Union
 
 from pyrogram import Client, Filters, Message
 
@@ -30,7 +31,7 @@ from ..functions.filters import hide_channel, is_ban_text, is_bio_text, is_class
 from ..functions.filters import is_high_score_user, is_in_config, is_limited_user, is_nm_text, is_not_allowed
 from ..functions.filters import is_regex_text, is_watch_user, new_group, test_group
 from ..functions.group import delete_message, leave_group
-from ..functions.ids import init_group_id, init_user_id
+from ..functions.ids import init_group_id, init_user_id, set_user_time
 from ..functions.receive import receive_add_bad, receive_add_except, receive_captcha_flood, receive_captcha_kicked_user
 from ..functions.receive import receive_captcha_kicked_users, receive_config_commit, receive_clear_data
 from ..functions.receive import receive_config_reply, receive_config_show, receive_declared_message
@@ -38,6 +39,7 @@ from ..functions.receive import receive_flood_score, receive_preview, receive_le
 from ..functions.receive import receive_refresh, receive_remove_bad, receive_remove_except, receive_remove_score
 from ..functions.receive import receive_remove_watch, receive_remove_white, receive_rollback, receive_text_data
 from ..functions.receive import receive_user_score, receive_watch_user, receive_white_users
+from ..functions.regex import start_deadline, stop_deadline
 from ..functions.telegram import get_admins, get_user_bio, send_message
 from ..functions.tests import clean_test
 from ..functions.timers import backup_files, send_count
@@ -51,7 +53,7 @@ logger = logging.getLogger(__name__)
                    & ~test_group & authorized_group
                    & from_user & ~class_d
                    & ~declared_message)
-def check(client: Client, message: Message) -> bool:
+def check(client: Client, message: Message, rescan: bool = False) -> bool:
     # Check the messages sent from groups
 
     has_text = bool(message and (message.text or message.caption))
@@ -61,6 +63,9 @@ def check(client: Client, message: Message) -> bool:
     else:
         glovar.locks["message"].acquire()
 
+    # Limit the time spent on the rules, the re-scan has a longer limit
+    start_deadline(glovar.regex_deadline * (rescan and 10 or 1))
+
     try:
         # Basic data
         gid = message.chat.id
@@ -152,6 +157,13 @@ def check(client: Client, message: Message) -> bool:
         else:
             glovar.locks["message"].release()
 
+        # Check the message again later if the scanning is not finished in time
+        if stop_deadline():
+            if rescan:
+                logger.warning(f"Rescan message {message.chat.id} {message.message_id} timeout")
+            else:
+                delay(glovar.regex_rescan, check, [client, message, True])
+
     return False
 
 
@@ -206,8 +218,7 @@ def check_join(client: Client, message: Message) -> bool:
                 continue
 
             # Update user's join status
-            glovar.user_ids[uid]["join"][gid] = now
-            save("user_ids")
+            set_user_time(uid, "join", gid, now)
 
         # Delete service message
         if not is_in_config(gid, "ser"):
@@ -367,8 +378,26 @@ def process_data(client: Client, message: Message) -> bool:
         receivers = data["to"]
         action = data["action"]
         action_type = data["type"]
-        data = data["data"]
 
+        # A batched envelope holds a list of records, each one is processed like a single envelope
+        records = data["data"] if data.get("batch") else [data["data"]]
+
+        for data in records:
+            process_record(client, message, sender, receivers, action, action_type, data)
+
+        return True
+    except Exception as e:
+        logger.warning(f"Process data error: {e}", exc_info=True)
+    finally:
+        glovar.locks["receive"].release()
+
+    return False
+
+
+def process_record(client: Client, message: Message, sender: str, receivers: List[str], action: str,
+                   action_type: str, data: Union[bool, dict, int, list, str]) -> bool:
+    # Process a record of the data in exchange channel
+    try:
         # This will look awkward,
         # seems like it can be simplified,
         # but this is to ensure that the permissions are clear,
@@ -561,9 +590,7 @@ def process_data(client: Client, message: Message) -> bool:
 
         return True
     except Exception as e:
-        logger.warning(f"Process data error: {e}", exc_info=True)
-    finally:
-        glovar.locks["receive"].release()
+        logger.warning(f"Process record error: {e}", exc_info=True)
 
     return False
 